@@ -0,0 +1,116 @@
+'''
+Micro benchmarks for taintmode.py
+
+Use:
+
+    python bench.py
+
+Each workload is timed twice: with the fast path for untainted operands
+(taintmode.untainted_types) and with it disabled, so the difference is the
+time spent collecting tags from plain builtin values.
+
+Then a source, a cleaner and a sink are timed undecorated, decorated with
+taint tracking on, and decorated with it off (see taintmode.taint_tracking).
+'''
+import timeit
+
+import taintmode
+from taintmode import taint, chr, ord, len
+
+
+def ej6(n):
+    '''The string operations of examples/ej6.py over a tainted input.'''
+    m1 = n + "hola"
+    m2 = "chau " + n
+    o = n[0]
+    p = o * 8
+    q = (n * 10)[2:4]
+    r = 10 * q
+    s = n.join([' ', ' ', ' '])
+    return m1, m2, p, r, s
+
+
+def conv(s):
+    '''Character by character copy, as conv in conversion.py.'''
+    r = ''
+    for a in range(0, len(s)):
+        r += chr(ord(s[a]))
+    return r
+
+
+def conv_builder(s):
+    '''conv, with a StringBuilder instead of +=.'''
+    b = taintmode.StringBuilder()
+    for a in range(0, len(s)):
+        b.write(chr(ord(s[a])))
+    return b.getvalue()
+
+
+workloads = [
+    ('ej6', lambda: ej6(taint('attack_command')), 20000),
+    ('conversion', lambda: conv(taint('attack_command' * 4)), 1000),
+    ('builder', lambda: conv_builder(taint('attack_command' * 4)), 1000),
+]
+
+
+def pipeline(untrusted=taintmode.untrusted, cleaner=taintmode.cleaner,
+             ssink=taintmode.ssink):
+    '''A query read, cleaned and run, decorated with the given decorators.'''
+    @untrusted
+    def source():
+        return "1' or '1'='1"
+
+    @cleaner(taintmode.SQLI)
+    def quote(s):
+        return s.replace("'", "''")
+
+    @ssink(taintmode.SQLI)
+    def query(q):
+        return q
+    return lambda: query("select * from t where id = '%s'" %
+                         quote(source()))
+
+
+def run_switch(number=100000):
+    '''Time pipeline undecorated, with taint tracking on and off.'''
+    enabled = taintmode.ENABLED
+    plain = pipeline(lambda f: f, lambda v: lambda f: f, lambda v: lambda f: f)
+    try:
+        taintmode.taint_tracking(True)
+        on = pipeline()
+        taintmode.taint_tracking(False)
+        off = pipeline()
+    finally:
+        taintmode.taint_tracking(enabled)
+    return [(name, min(timeit.repeat(f, number=number, repeat=3)))
+            for name, f in [('plain', plain), ('on', on), ('off', off)]]
+
+
+def run(number_scale=1):
+    results = []
+    fast = taintmode.untainted_types
+    for name, f, number in workloads:
+        number = int(number * number_scale)
+        with_fast = min(timeit.repeat(f, number=number, repeat=3))
+        taintmode.untainted_types = frozenset()
+        try:
+            without_fast = min(timeit.repeat(f, number=number, repeat=3))
+        finally:
+            taintmode.untainted_types = fast
+        results.append((name, number, without_fast, with_fast))
+    return results
+
+
+if __name__ == '__main__':
+    print '%-12s %8s %12s %12s %8s' % ('workload', 'runs', 'no fast (s)',
+                                       'fast (s)', 'speedup')
+    for name, number, without_fast, with_fast in run():
+        print '%-12s %8d %12.4f %12.4f %7.2fx' % (name, number, without_fast,
+                                                  with_fast,
+                                                  without_fast / with_fast)
+    print
+    print '%-12s %12s %8s' % ('tracking', 'time (s)', 'overhead')
+    results = run_switch()
+    plain = results[0][1]
+    for name, t in results:
+        print '%-12s %12.4f %7.2fx' % (name, t, t / plain)
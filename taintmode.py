@@ -21,20 +21,60 @@ You should have received a copy of the GNU General Public License
 along with taintmode.py.  If not, see <http://www.gnu.org/licenses/>.
 
 '''
+import array
+import atexit
+import bisect
 import inspect
+import json
+import linecache
+import operator
+import os
+import re
+import socket
+import string
 import sys
-from itertools import chain
+import threading
+import time
+from collections import MutableSet, deque
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
 
 
 __version__ = 'trunk-svn-2'
 
 __all__ = ['tainted', 'taint', 'untrusted', 'untrusted_args', 'ssink',
-           'validator', 'cleaner', 'STR', 'INT', 'FLOAT', 'UNICODE', 'chr',
-           'ord', 'len', 'ends_execution', 'XSS', 'SQLI', 'OSI', 'II']
+           'validator', 'cleaner', 'STR', 'INT', 'FLOAT', 'UNICODE',
+           'BYTEARRAY', 'MEMORYVIEW', 'PSTR', 'PUNICODE',
+           'StringBuilder', 'Column', 'taint_many', 'tainted_mask',
+           'clean_many', 'concatenate', 'Violation', 'StreamReporter',
+           'QueueReporter', 'json_lines', 'Sampler', 'Skipped', 'profiling',
+           'stats_snapshot', 'dump_stats', 'chr', 'ord', 'len',
+           'ends_execution', 'taint_tracking', 'positional_taint',
+           'taint_ranges',
+           'XSS', 'SQLI', 'OSI', 'II']
 
 
 ENDS = False
 RAISES = False
+MAX_DEPTH = None
+LAZY = False
+POSITIONAL = False
+# a Sampler deciding which violations reach reached, all if None
+SAMPLER = None
+# taint tracking, see taint_tracking
+ENABLED = os.environ.get('TAINTMODE_OFF', '') in ('', '0')
+# count the use of the functions decorated (see profiling)
+PROFILE = os.environ.get('TAINTMODE_PROFILE', '') not in ('', '0')
+# modules whose frames reached skips looking for the line of the violation
+hidden_modules = set()
 KEYS  = [XSS, SQLI, OSI, II] = range(1, 5)
 TAGS = set(KEYS)
 
@@ -43,23 +83,203 @@ class TaintException(Exception):
     pass
 
 
+# ------------------------- Taint labels --------------------------------------
+# Every tag gets its own bit the first time it is seen. A label is an
+# immutable set of tags backed by the bitmask of their bits. Labels are
+# interned, so values carrying the same tags share one Label object, and
+# the results of union and removal are memoized on each label.
+
+_bits = {}
+_labels = {}
+
+
+def tag_bit(v):
+    '''Return the bit assigned to the tag v, registering v if needed.'''
+    try:
+        return _bits[v]
+    except KeyError:
+        b = _bits[v] = 1 << len(_bits)
+        return b
+
+
+class Label(object):
+    '''
+    Immutable, interned set of tags.
+
+    Don't instantiate it directly, use label() or label_of() instead.
+    '''
+    __slots__ = ('mask', '_or', '_add', '_discard')
+
+    def __init__(self, mask):
+        self.mask = mask
+        self._or = {}
+        self._add = {}
+        self._discard = {}
+
+    def __or__(self, other):
+        try:
+            return self._or[other]
+        except KeyError:
+            r = self._or[other] = label(self.mask | other.mask)
+            return r
+
+    def add(self, v):
+        '''Return the label with the tag v added.'''
+        try:
+            return self._add[v]
+        except KeyError:
+            r = self._add[v] = label(self.mask | tag_bit(v))
+            return r
+
+    def discard(self, v):
+        '''Return the label with the tag v removed.'''
+        try:
+            return self._discard[v]
+        except KeyError:
+            r = self._discard[v] = label(self.mask & ~_bits.get(v, 0))
+            return r
+
+    def __contains__(self, v):
+        return bool(self.mask & _bits.get(v, 0))
+
+    def __nonzero__(self):
+        return self.mask != 0
+
+    def __iter__(self):
+        return iter(tags_of(self.mask))
+
+    def __len__(self):
+        return bin(self.mask).count('1')
+
+    def __repr__(self):
+        return 'Label(%r)' % tags_of(self.mask)
+
+
+def label(m):
+    '''Return the interned label for the bitmask m.'''
+    try:
+        return _labels[m]
+    except KeyError:
+        l = _labels[m] = Label(m)
+        return l
+
+
+def label_of(ts):
+    '''Return the label for an iterable of tags ts.'''
+    m = 0
+    for v in ts:
+        m |= tag_bit(v)
+    return label(m)
+
+
+def bits(m):
+    '''Yield each bit set in the bitmask m.'''
+    while m:
+        b = m & -m
+        yield b
+        m ^= b
+
+
+def tags_of(m):
+    '''Return the set of tags in the bitmask m.'''
+    return set(v for v, b in _bits.iteritems() if m & b)
+
+
+for _k in KEYS:
+    tag_bit(_k)
+
+EMPTY = label(0)
+
+
+def set_label(o, l):
+    '''Replace the label of the taint-aware value o with l.'''
+    o._set_label(l)
+
+
+class TaintSet(MutableSet):
+    '''
+    Set-like view over the tags of a taint-aware value.
+
+    Reads and writes go straight to the label of the value, so code using
+    o.taints as a set keeps working.
+    '''
+    __slots__ = ('owner',)
+
+    # results of |, &, - and ^ are plain sets, not views
+    _from_iterable = classmethod(lambda cls, it: set(it))
+
+    def __init__(self, owner):
+        self.owner = owner
+
+    def __contains__(self, v):
+        return v in self.owner._taint_label
+
+    def __iter__(self):
+        return iter(self.owner._taint_label)
+
+    def __len__(self):
+        return self.owner._taint_label.__len__()
+
+    def add(self, v):
+        set_label(self.owner, self.owner._taint_label.add(v))
+
+    def discard(self, v):
+        set_label(self.owner, self.owner._taint_label.discard(v))
+
+    def update(self, *others):
+        m = self.owner._taint_label.mask
+        for o in others:
+            for v in o:
+                m |= tag_bit(v)
+        set_label(self.owner, label(m))
+
+    def copy(self):
+        return set(self)
+
+    def union(self, *others):
+        return set(self).union(*others)
+
+    def __repr__(self):
+        return repr(tags_of(self.owner._taint_label.mask))
+
+
 def ends_execution(b=True):
     global ENDS
     ENDS = b
 
 
+def taint_tracking(b=True):
+    '''
+    Turn taint tracking on or off. Setting the TAINTMODE_OFF environment
+    variable (to anything but 0) turns it off from the start.
+
+    While off, the decorators return the function decorated as it is and
+    taint returns its argument, so the program runs with no overhead. The
+    functions decorated before keep their wrappers: call it before
+    importing the modules using the decorators.
+    '''
+    global ENABLED
+    ENABLED = b
+
+
 # ------------------------- Taint-aware functions -----------------------------
 def propagate_func(original):
+    if not ENABLED:
+        return original
     def inner (*args, **kwargs):
-        t = set()
+        t = EMPTY
         for a in args:
-            collect_tags(a, t)
-        for v in kwargs.values():
-            collect_tags(v, t)
+            if type(a) not in untainted_types:
+                t |= collect_tags(a)
+        if kwargs:
+            for v in kwargs.itervalues():
+                t |= collect_tags(v)
         r  = original(*args, **kwargs)
         if t:
             r = taint_aware(r, t)
         return r
+    # for call sites known to never get tainted values (see wrapstrings/)
+    inner.trusted = original
     return inner
 
 len = propagate_func(len)
@@ -68,47 +288,630 @@ chr = propagate_func(chr)
 
 # ------------------------- Auxiliaries functions -----------------------------
 
-def mapt(o, f, check=lambda o: type(o) in tclasses):
+containers = (list, tuple, set, dict)
+
+# Values of exactly these types are never taint-aware nor containers, so
+# collecting their tags can be skipped with a single type lookup.
+untainted_types = frozenset([str, unicode, int, long, float, bool, complex,
+                             type(None)])
+
+
+def _check_depth(depth):
+    if MAX_DEPTH is not None and depth > MAX_DEPTH:
+        raise TaintException('containers nested deeper than %d' % MAX_DEPTH)
+
+
+def mapt(o, f, check=lambda o: dispatch[type(o)] is not None, inplace=False):
+    '''
+    Return o with every value x such that check(x) replaced by f(x).
+
+    Lists, tuples, sets and dicts are walked iteratively, so deep structures
+    don't hit the recursion limit. A container is reused as it is when
+    nothing inside it changes, and copied otherwise. If inplace is true,
+    lists, sets and dicts are updated in place instead, keeping their
+    identity (and class); tuples are still copied when they change. Each
+    container is handled only once, so aliasing and cycles are kept.
+    Containers nested deeper than MAX_DEPTH raise TaintException.
+    '''
     if check(o):
         return f(o)
-    elif isinstance(o, list):
-        return [mapt(x, f, check) for x in o]
-    elif isinstance(o, tuple):
-        return tuple(mapt(x, f, check) for x in o)
-    elif isinstance(o, set):
-        return  set(mapt(x, f, check) for x in o)
-    elif isinstance(o, dict):
-        klass = type(o) # It's quite common for frameworks to extend dict
-                        # with useful new methdos - i.e. web.py
-        return klass((k, mapt(v, f, check)) for k, v in o.iteritems())
-    else:
+    if not isinstance(o, containers):
         return o
 
+    memo = {}   # id -> result, None while in progress
+    mutable = (list, set, dict) if inplace else ()
+
+    def frame(c):
+        memo[id(c)] = c if isinstance(c, mutable) else None
+        if isinstance(c, dict):
+            return [c, c.iteritems(), [], False, None]
+        return [c, iter(c), [], False, None]
+
+    def reached_again(c):
+        # a cycle: lists and dicts get an empty copy filled at the end,
+        # tuples and sets can't, so the cycle sees the original
+        if isinstance(c, list):
+            new = memo[id(c)] = []
+        elif isinstance(c, dict):
+            klass = type(c) # It's quite common for frameworks to extend dict
+                            # with useful new methdos - i.e. web.py
+            new = memo[id(c)] = klass()
+        else:
+            new = c
+        return new
+
+    def finish(c, results, changed):
+        new = memo[id(c)]
+        if new is c:
+            if changed:
+                if isinstance(c, list):
+                    c[:] = results
+                elif isinstance(c, dict):
+                    dict.update(c, results)
+                else:
+                    c.clear()
+                    c.update(results)
+        elif new is not None:
+            if isinstance(c, list):
+                new.extend(results)
+            else:
+                new.update(results)
+        elif not changed:
+            new = c
+        elif isinstance(c, list):
+            new = results
+        elif isinstance(c, dict):
+            new = type(c)()
+            new.update(results)
+        elif isinstance(c, tuple):
+            new = tuple(results)
+        else:
+            new = set(results)
+        memo[id(c)] = new
+        return new
+
+    stack = [frame(o)]
+    depth = 1
+    while True:
+        fr = stack[-1]
+        isdict = isinstance(fr[0], dict)
+        for x in fr[1]:
+            if isdict:
+                k, x = x
+            if check(x):
+                y = f(x)
+            elif isinstance(x, containers):
+                if id(x) not in memo:
+                    depth += 1
+                    _check_depth(depth)
+                    if isdict:
+                        fr[4] = k
+                    stack.append(frame(x))
+                    break
+                y = memo[id(x)]
+                if y is None:
+                    y = reached_again(x)
+            else:
+                y = x
+            if y is not x:
+                fr[3] = True
+            fr[2].append((k, y) if isdict else y)
+        else:
+            c, _, results, changed, _ = stack.pop()
+            depth -= 1
+            new = finish(c, results, changed)
+            if not stack:
+                return new
+            parent = stack[-1]
+            if new is not c:
+                parent[3] = True
+            if isinstance(parent[0], dict):
+                parent[2].append((parent[4], new))
+            else:
+                parent[2].append(new)
+
+
+def leaves(o):
+    '''
+    Yield every value in o that is not a list, tuple, set or dict.
+
+    Containers are walked in place, iteratively, without being rebuilt. Each
+    one is visited only once, so cyclic structures are fine. Containers
+    nested deeper than MAX_DEPTH raise TaintException.
+    '''
+    if not isinstance(o, containers):
+        yield o
+        return
+    seen = set([id(o)])
+    stack = [(o, 1)]
+    while stack:
+        c, depth = stack.pop()
+        for x in (c.itervalues() if isinstance(c, dict) else c):
+            if not isinstance(x, containers):
+                yield x
+            elif id(x) not in seen:
+                _check_depth(depth + 1)
+                seen.add(id(x))
+                stack.append((x, depth + 1))
+
 
 def remove_taint(v):
     def _remove(o):
-        if hasattr(o, 'taints'):
-            o.taints.discard(v)
+        if hasattr(o, '_taint_label'):
+            set_label(o, o._taint_label.discard(v))
     return _remove
 
 
 def remove_tags(r, v):
-    mapt(r, remove_taint(v), lambda o: True)
+    _remove = remove_taint(v)
+    for o in leaves(r):
+        _remove(o)
+
 
+def collect_tags(s, stop=0):
+    '''
+    Collect the labels of every taint-aware value in s.
 
-def collect_tags(s, t):
-    '''Collect tags from a source s into a target t.'''
-    mapt(s, lambda o: t.update(o.taints), lambda o: hasattr(o, 'taints'))
+    If stop is a non zero bitmask the walk ends as soon as one of its bits
+    has been collected; the returned label is then only complete regarding
+    stop.
+    '''
+    if type(s) in untainted_types:
+        return EMPTY
+    l = getattr(s, '_taint_label', None)
+    if l is not None:
+        return l
+    acc = EMPTY
+    for o in leaves(s):
+        if type(o) in untainted_types:
+            continue
+        l = getattr(o, '_taint_label', None)
+        if l is not None:
+            acc |= l
+            if acc.mask & stop:
+                break
+    return acc
 
 
 def update_tags(r, t):
-    mapt(r, lambda o: o.taints.update(t), lambda o: hasattr(o, 'taints'))
+    for o in leaves(r):
+        if hasattr(o, '_taint_label'):
+            set_label(o, o._taint_label | t)
 
 
-def taint_aware(r, ts=set()):
-    r = mapt(r, tclass)
-    update_tags(r, ts)
-    return r
+def taint_aware(r, t=EMPTY, inplace=False):
+    '''
+    Return r with every value in it taint-aware and tainted with t.
+
+    Containers are only copied when some value in them has to be converted,
+    or never if inplace is true (see mapt).
+    '''
+    def _aware(o):
+        k = dispatch[type(o)]
+        if k is not None:
+            return k._make(o, t)
+        set_label(o, o._taint_label | t)
+        return o
+    return mapt(r, _aware, lambda o: dispatch[type(o)] is not None or
+                                     hasattr(o, '_taint_label'), inplace)
+
+
+# ------------------------- Lazy containers -----------------------------------
+
+class Lazy(object):
+    '''
+    Mixin for the containers returned by untrusted in lazy mode.
+
+    Values are made taint-aware, with the label of the source, the first
+    time they are read, and stored back so later reads (and cleaners or
+    validators working on them) see the same object. Values stored by the
+    program are left as they are. Dict keys are never tainted, as in eager
+    mode.
+
+    The keys (or indexes) whose values are still raw are kept in _raw.
+    Reading values through C-level shortcuts bypasses this: dict(d), f(**d)
+    and d.update() on another dict with d as argument give the raw values.
+    Use d.copy() or iteration instead.
+    '''
+
+    def _setup(self, t, memo, raw):
+        self.__dict__.update(_lazy_label=t, _lazy_memo=memo, _raw=raw)
+
+    def _aware(self, x):
+        return lazy_aware(x, self._lazy_label, self._lazy_memo)
+
+
+class LazyDict(Lazy, dict):
+
+    def __init__(self, o, t, memo):
+        dict.__init__(self, o)
+        self._setup(t, memo, set(dict.iterkeys(self)))
+
+    def __getitem__(self, k):
+        x = dict.__getitem__(self, k)
+        if k in self._raw:
+            x = self._aware(x)
+            dict.__setitem__(self, k, x)
+            self._raw.discard(k)
+        return x
+
+    def _convert_all(self):
+        for k in list(self._raw):
+            self[k]
+
+    def get(self, k, d=None):
+        if dict.__contains__(self, k):
+            return self[k]
+        return d
+
+    def pop(self, k, *d):
+        if dict.__contains__(self, k):
+            x = self[k]
+            dict.__delitem__(self, k)
+            return x
+        return dict.pop(self, k, *d)
+
+    def popitem(self):
+        k, x = dict.popitem(self)
+        if k in self._raw:
+            self._raw.discard(k)
+            x = self._aware(x)
+        return k, x
+
+    def setdefault(self, k, d=None):
+        if not dict.__contains__(self, k):
+            self[k] = d
+        return self[k]
+
+    def itervalues(self):
+        for k in dict.keys(self):
+            yield self[k]
+
+    def iteritems(self):
+        for k in dict.keys(self):
+            yield k, self[k]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def viewvalues(self):
+        self._convert_all()
+        return dict.viewvalues(self)
+
+    def viewitems(self):
+        self._convert_all()
+        return dict.viewitems(self)
+
+    def copy(self):
+        self._convert_all()
+        return dict.copy(self)
+
+    def __setitem__(self, k, x):
+        self._raw.discard(k)
+        dict.__setitem__(self, k, x)
+
+    def __delitem__(self, k):
+        self._raw.discard(k)
+        dict.__delitem__(self, k)
+
+    def clear(self):
+        self._raw.clear()
+        dict.clear(self)
+
+    def update(self, *args, **kwargs):
+        for k, x in dict(*args, **kwargs).iteritems():
+            self[k] = x
+
+
+class LazyList(Lazy, list):
+    '''
+    Appending to, reading and setting values in the list keep it lazy;
+    other changes (i.e. insert or sort) make every value taint-aware first,
+    so _raw only has to follow the indexes that don't move.
+    '''
+
+    def __init__(self, o, t, memo):
+        list.__init__(self, o)
+        self._setup(t, memo, set(xrange(list.__len__(self))))
+
+    def _index(self, i):
+        n = list.__len__(self)
+        return i + n if i < 0 else i
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[n] for n in xrange(*i.indices(list.__len__(self)))]
+        x = list.__getitem__(self, i)
+        i = self._index(i)
+        if i in self._raw:
+            x = self._aware(x)
+            list.__setitem__(self, i, x)
+            self._raw.discard(i)
+        return x
+
+    def __getslice__(self, i, j):
+        return self[i:j:]
+
+    def _convert_all(self):
+        for i in list(self._raw):
+            self[i]
+
+    def __iter__(self):
+        n = 0
+        while n < list.__len__(self):
+            yield self[n]
+            n += 1
+
+    def __reversed__(self):
+        n = list.__len__(self)
+        while n > 0:
+            n -= 1
+            yield self[n]
+
+    def __add__(self, x):
+        return list(self.__iter__()) + x
+
+    def __mul__(self, n):
+        return list(self.__iter__()) * n
+
+    __rmul__ = __mul__
+
+    def pop(self, i=-1):
+        x = self[i]
+        if self._index(i) != list.__len__(self) - 1:
+            self._convert_all()
+        list.pop(self, i)
+        return x
+
+    def __setitem__(self, i, x):
+        if isinstance(i, slice):
+            self._convert_all()
+        else:
+            self._raw.discard(self._index(i))
+        list.__setitem__(self, i, x)
+
+    def __setslice__(self, i, j, x):
+        self[i:j:] = x
+
+    def __delitem__(self, i):
+        self._convert_all()
+        list.__delitem__(self, i)
+
+    def __delslice__(self, i, j):
+        del self[i:j:]
+
+    def insert(self, i, x):
+        self._convert_all()
+        list.insert(self, i, x)
+
+    def remove(self, x):
+        self._convert_all()
+        list.remove(self, x)
+
+    def sort(self, *args, **kwargs):
+        self._convert_all()
+        list.sort(self, *args, **kwargs)
+
+    def reverse(self):
+        self._convert_all()
+        list.reverse(self)
+
+    def __iadd__(self, x):
+        self.extend(x)
+        return self
+
+    def __imul__(self, n):
+        self._convert_all()
+        return list.__imul__(self, n)
+
+
+class LazyTuple(Lazy, tuple):
+
+    def __new__(cls, o, t, memo):
+        self = tuple.__new__(cls, o)
+        self._setup(t, memo, None)
+        self.__dict__['_cache'] = {}
+        return self
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return tuple(self[n] for n in xrange(*i.indices(tuple.__len__(self))))
+        if i < 0:
+            i += tuple.__len__(self)
+        try:
+            return self._cache[i]
+        except KeyError:
+            x = self._cache[i] = self._aware(tuple.__getitem__(self, i))
+            return x
+
+    def __getslice__(self, i, j):
+        return self[i:j:]
+
+    def __iter__(self):
+        for n in xrange(tuple.__len__(self)):
+            yield self[n]
+
+    def __reversed__(self):
+        for n in reversed(xrange(tuple.__len__(self))):
+            yield self[n]
+
+    def __add__(self, x):
+        return tuple(self.__iter__()) + x
+
+    def __mul__(self, n):
+        return tuple(self.__iter__()) * n
+
+    __rmul__ = __mul__
+
+
+lazy_dicts = {dict: LazyDict}
+
+
+def lazy_aware(r, t, memo=None):
+    '''
+    Return r taint-aware and tainted with t, deferring the work on the
+    values inside lists, tuples and dicts until they are read.
+
+    Dict subclasses keep their class (i.e. web.py's Storage). memo maps the
+    containers already seen to their lazy versions, so aliasing and cycles
+    are kept.
+    '''
+    if not isinstance(r, (list, tuple, dict)):
+        return taint_aware(r, t)
+    if memo is None:
+        memo = {}
+    try:
+        return memo[id(r)][1]
+    except KeyError:
+        pass
+    if isinstance(r, dict):
+        klass = type(r)
+        if klass not in lazy_dicts:
+            lazy_dicts[klass] = type('Lazy' + klass.__name__, (LazyDict, klass), {})
+        klass = lazy_dicts[klass]
+    elif isinstance(r, list):
+        klass = LazyList
+    else:
+        klass = LazyTuple
+    p = klass(r, t, memo)
+    memo[id(r)] = (r, p)    # keep r alive, its id is the key
+    return p
+
+
+# ------------------------- Profiling -----------------------------------------
+
+# counters per decorated function (and per method of the taint-aware
+# classes), by name
+stats = {}
+_profile = threading.local()
+_plain = {'mapt': mapt, 'collect_tags': collect_tags}
+
+
+def profiling(on=True):
+    '''
+    Start, or stop, counting the use of the functions decorated from then
+    on, and the time spent in mapt and collect_tags for each. The methods of
+    the taint-aware classes are only counted if the TAINTMODE_PROFILE
+    environment variable is set (to anything but 0) when this module is
+    imported.
+    '''
+    global PROFILE
+    PROFILE = on
+    for name, f in _plain.iteritems():
+        globals()[name] = timed(f, name + '_time') if on else f
+
+
+def timed(f, field):
+    '''Wrap f adding the time spent in it to the counters being run.'''
+    def inner(*args, **kwargs):
+        s = getattr(_profile, 'stats', None)
+        if s is None or field in _profile.timing:
+            # not profiling, or a recursive call already timed
+            return f(*args, **kwargs)
+        _profile.timing.add(field)
+        start = time.time()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            s[field] += time.time() - start
+            _profile.timing.discard(field)
+    return inner
+
+
+def wrapped_bytes(o, memo=None):
+    '''Length of the strings in o.'''
+    if isinstance(o, basestring):
+        return str_len(o)
+    if not isinstance(o, containers) or isinstance(o, Lazy):
+        return 0    # lazy containers taint their values when read
+    if memo is None:
+        memo = set()
+    elif id(o) in memo:
+        return 0
+    memo.add(id(o))
+    if isinstance(o, dict):
+        o = o.itervalues()
+    return sum(wrapped_bytes(x, memo) for x in o)
+
+
+def profiled(kind, name, inner, size=None):
+    '''
+    Return inner, the function returned by a decorator of kind, counting
+    its calls, the calls with tainted arguments, its time and (with the
+    function size, given args, kwargs and the result) the bytes tainted
+    in stats[name]. Calls made while another call counted in stats[name]
+    runs (stacked decorators of a function, recursion) are part of that
+    one. inner itself is returned if PROFILE is off.
+    '''
+    if not PROFILE:
+        return inner
+    s = stats.setdefault(name, {'kind': kind, 'calls': 0, 'tainted': 0,
+                                'bytes': 0, 'time': 0.0, 'mapt_time': 0.0,
+                                'collect_tags_time': 0.0})
+
+    def profile(*args, **kwargs):
+        outer = getattr(_profile, 'stats', None)
+        if outer is s:
+            return inner(*args, **kwargs)
+        s['calls'] += 1
+        for a in args + tuple(kwargs.itervalues()):
+            if _plain['collect_tags'](a):
+                s['tainted'] += 1
+                break
+        if outer is None:
+            _profile.timing = set()
+        _profile.stats = s
+        start = time.time()
+        try:
+            r = inner(*args, **kwargs)
+        finally:
+            s['time'] += time.time() - start
+            _profile.stats = outer
+        if size is not None:
+            s['bytes'] += size(args, kwargs, r)
+        return r
+    profile.__dict__.update(inner.__dict__)
+    return named(profile, inner)
+
+
+def named(inner, f):
+    '''
+    Give inner the name and module of f, the function it wraps, like
+    functools.wraps but for callables missing them too.
+    '''
+    for a in ('__name__', '__module__'):
+        if hasattr(f, a):
+            setattr(inner, a, getattr(f, a))
+    return inner
+
+
+def qualified_name(f):
+    return '%s.%s' % (getattr(f, '__module__', None),
+                      getattr(f, '__name__', f))
+
+
+def stats_snapshot():
+    '''Return a copy of the counters.'''
+    return dict((k, dict(v)) for k, v in stats.iteritems())
+
+
+def reset_stats():
+    for s in stats.itervalues():
+        for k, v in s.iteritems():
+            if k != 'kind':
+                s[k] = type(v)()
+
+
+def dump_stats(f):
+    '''Write the counters to the file f, as JSON.'''
+    json.dump(stats_snapshot(), f, indent=1, sort_keys=True)
+
+
+if PROFILE:
+    profiling()
 
 
 # ------------------------- Decorators ----------------------------------------
@@ -176,6 +979,8 @@ def untrusted_args(nargs=[], nkwargs=[]):
     42
     '''
     def _untrusted_args(f):
+        if not ENABLED:
+            return f
         def inner(*args, **kwargs):
             args = list(args)   # args is a tuple - add a test
             for n in nargs:
@@ -184,15 +989,29 @@ def untrusted_args(nargs=[], nkwargs=[]):
                 kwargs[n] = mapt(kwargs[n], taint)
             r = f(*args, **kwargs)
             return r
-        return inner
+        return profiled('untrusted_args', qualified_name(f), named(inner, f),
+                        lambda args, kwargs, r:
+                            sum(wrapped_bytes(args[n]) for n in nargs) +
+                            sum(wrapped_bytes(kwargs[n]) for n in nkwargs))
     return _untrusted_args
 
-def untrusted(f):
+def untrusted(f, lazy=None, inplace=False):
     '''
     Mark a function or method as untrusted.
 
     The returned value will be tainted for all the types of taint.
 
+    If lazy is true (by default, the module-level variable LAZY is used),
+    lists, tuples and dicts in the returned value are not walked at once.
+    Their values are made taint-aware when the program reads them, so only
+    the fields actually used are paid for. Reading values through C-level
+    shortcuts like dict(d) or f(**d) bypasses this, use d.copy() or
+    iteration instead.
+
+    If inplace is true, the lists, sets and dicts returned by f are tainted
+    in place instead of being copied. Use it for sources that build a new
+    value on each call, like web.py's web.input.
+
     Examples
     ========
 
@@ -217,10 +1036,16 @@ def untrusted(f):
     >>> import web
     >>> web.input = untrusted(web.input)
     '''
+    if not ENABLED:
+        return f
+
     def inner(*args, **kwargs):
         r = f(*args, **kwargs)
-        return taint_aware(r, TAGS)
-    return inner
+        if LAZY if lazy is None else lazy:
+            return lazy_aware(r, label_of(TAGS))
+        return taint_aware(r, label_of(TAGS), inplace)
+    return profiled('untrusted', qualified_name(f), named(inner, f),
+                    lambda args, kwargs, r: wrapped_bytes(r))
 
 def validator(v, cond=True, nargs=[], nkwargs=[]):
     '''
@@ -242,6 +1067,8 @@ def validator(v, cond=True, nargs=[], nkwargs=[]):
     for a function called valid_mail, cond is liked to be True.
     '''
     def _validator(f):
+        if not ENABLED:
+            return f
         def inner(*args, **kwargs):
             r = f(*args, **kwargs)
             if r == cond:
@@ -250,7 +1077,8 @@ def validator(v, cond=True, nargs=[], nkwargs=[]):
                 for a in tovalid:
                     remove_tags(a, v)
             return r
-        return inner
+        inner.trusted = f
+        return profiled('validator', qualified_name(f), named(inner, f))
     return _validator
 
 
@@ -293,14 +1121,290 @@ def cleaner(v):
     this value this value is placed in the WHERE clause of a sql delete statment: 21
     '''
     def _cleaner(f):
+        if not ENABLED:
+            return f
         def inner(*args, **kwargs):
             r = f(*args, **kwargs)
             remove_tags(r, v)
             return r
-        return inner
+        inner.trusted = f
+        return profiled('cleaner', qualified_name(f), named(inner, f))
     return _cleaner
 
-def reached(t, v=None):
+# ------------------------- Violations ----------------------------------------
+
+# longest tainted value kept in a violation
+MAX_VALUE_LEN = 200
+
+
+class Violation(object):
+    '''
+    A tainted value reaching a sensitive sink: the code object and line
+    where the sink was called, the vulnerability tag (None for any), the
+    name of the sink and the value, truncated to MAX_VALUE_LEN characters.
+
+    The lines around the call are only read when context is called, from
+    the line cache.
+    '''
+    __slots__ = ('code', 'lineno', 'tag', 'sink', 'value', 'ranges')
+    count = 1
+
+    def __init__(self, t, frame, tag=None, sink=None):
+        self.code = frame.f_code
+        self.lineno = frame.f_lineno
+        self.tag = tag
+        self.sink = sink
+        self.ranges = getattr(t, '_taint_ranges', None)
+        if isinstance(t, basestring):
+            # one more character than kept, to tell if it was truncated
+            t = t[:MAX_VALUE_LEN + 1]
+        value = '%s' % (t,)
+        if value.__len__() > MAX_VALUE_LEN:
+            value = value[:MAX_VALUE_LEN] + '...'
+        self.value = value
+
+    @property
+    def filename(self):
+        return self.code.co_filename
+
+    def context(self, n=3):
+        '''Return the source lines around the call, the call marked.'''
+        lines = ['    %s' % l for l in linecache.getlines(self.filename)]
+        lno = self.lineno - 1
+        if 0 <= lno < lines.__len__():
+            lines[lno] = '--> ' + lines[lno][4:]
+        return lines[lno - n: lno + n]
+
+    def record(self):
+        '''Return the violation as a dict, for QueueReporter.'''
+        return {'file': self.filename, 'line': self.lineno,
+                'function': self.code.co_name, 'tag': self.tag,
+                'sink': self.sink, 'value': self.value, 'count': 1}
+
+    def __str__(self):
+        r = ["=" * 79,
+             "Violation in line %d from file %s" % (self.lineno,
+                                                     self.filename),
+             # Localize this message
+             "Tainted value: %s" % self.value]
+        if self.ranges is not None:
+            r.append("Tainted characters: %s" % ', '.join(
+                '%d-%d' % (s, e) for s, e, l in self.ranges))
+        r.extend(['-' * 79, "".join(self.context()), "=" * 79])
+        return '\n'.join(r)
+
+
+class StreamReporter(object):
+    '''
+    Write violations to stream (sys.stdout when None), buffer_size of them
+    at a time. Any object with report and flush methods can be used as the
+    module-level reporter instead.
+    '''
+
+    def __init__(self, stream=None, buffer_size=1):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.buffer = []
+
+    def report(self, violation):
+        self.buffer.append(violation)
+        if self.buffer.__len__() >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        events, self.buffer = self.buffer, []
+        if events:
+            stream = self.stream or sys.stdout
+            stream.write(''.join('%s\n' % e for e in events))
+
+
+class QueueReporter(object):
+    '''
+    Queue violations for a background thread, which gives them to write, a
+    list of records (see Violation.record) at a time, every interval
+    seconds.
+
+    The violations of a batch from the same file, line, sink and tag are
+    written as one record with their count, and so are the Skipped of a
+    Sampler. At most rate records per second
+    are written, the count of the violations left out is kept in dropped.
+    If more than maxlen violations are waiting, the oldest are lost.
+    '''
+
+    def __init__(self, write, interval=1.0, rate=100, maxlen=10000):
+        self.write = write
+        self.interval = interval
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.time()
+        self.dropped = 0
+        # deque appends and pops are atomic, report takes no lock
+        self.queue = deque(maxlen=maxlen)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run,
+                                       name='taintmode reporter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def report(self, violation):
+        self.queue.append(violation)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.flush()
+
+    def batch(self):
+        '''Take the waiting violations, as records.'''
+        records = []
+        seen = {}
+        while True:
+            try:
+                v = self.queue.popleft()
+            except IndexError:
+                break
+            key = (type(v), v.filename, v.lineno, v.sink, v.tag)
+            r = seen.get(key)
+            if r is None:
+                r = seen[key] = v.record()
+                records.append(r)
+            else:
+                r['count'] += v.count
+        return records
+
+    def flush(self):
+        with self.lock:
+            records = self.batch()
+            if not records:
+                return
+            now = time.time()
+            self.allowance = min(self.rate, self.allowance +
+                                            (now - self.last) * self.rate)
+            self.last = now
+            n = int(self.allowance)
+            if records.__len__() > n:
+                self.dropped += sum(r['count'] for r in records[n:])
+                records = records[:n]
+            self.allowance -= records.__len__()
+            if records:
+                self.write(records)
+
+    def close(self):
+        '''Stop the thread and write what is waiting.'''
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+
+
+def json_lines(stream):
+    '''Return a writer for QueueReporter appending JSON lines to stream.'''
+    def write(records):
+        stream.write(''.join(json.dumps(r) + '\n' for r in records))
+        stream.flush()
+    return write
+
+
+def syslog(address=('localhost', 514), priority=12):
+    '''
+    Return a writer for QueueReporter sending a syslog datagram, with the
+    record in JSON, per record. address is a (host, port) pair or the path
+    of a unix socket, priority is user.warning by default.
+    '''
+    if isinstance(address, tuple):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def write(records):
+        for r in records:
+            sock.sendto('<%d>taintmode: %s' % (priority, json.dumps(r)),
+                        address)
+    return write
+
+
+class Skipped(object):
+    '''
+    The count of the violations of a call site left out by a Sampler, given
+    to the reporter like a Violation.
+    '''
+    __slots__ = ('code', 'lineno', 'sink', 'count')
+    tag = None
+
+    def __init__(self, code, lineno, sink, count):
+        self.code = code
+        self.lineno = lineno
+        self.sink = sink
+        self.count = count
+
+    @property
+    def filename(self):
+        return self.code.co_filename
+
+    def record(self):
+        '''Return the count as a dict, for QueueReporter.'''
+        return {'file': self.filename, 'line': self.lineno,
+                'function': self.code.co_name, 'tag': None,
+                'sink': self.sink, 'value': None, 'count': self.count,
+                'skipped': True}
+
+    def __str__(self):
+        return ("%d violations not reported in line %d from file %s "
+                "(sink %s)" % (self.count, self.lineno, self.filename,
+                               self.sink))
+
+
+class Sampler(object):
+    '''
+    Sampling of the violations per call site, for SAMPLER.
+
+    The first violations of a site (a line calling a sink) reach reached,
+    then one in every. The rest only increment a counter, and every period
+    seconds (None for never) summary is called with those counted since
+    the last summary.
+    '''
+
+    def __init__(self, first=10, every=100, period=60.0):
+        self.first = first
+        self.every = every
+        self.period = period
+        self.counts = {}
+        self.skipped = {}
+        self.last = time.time()
+
+    def sample(self, frame, sink):
+        '''Tell if the violation of sink called in frame is reported.'''
+        key = (frame.f_code, frame.f_lineno, sink)
+        n = self.counts.get(key, 0) + 1
+        self.counts[key] = n
+        keep = n <= self.first or (n - self.first) % self.every == 0
+        if not keep:
+            self.skipped[key] = self.skipped.get(key, 0) + 1
+        if self.period is not None and \
+           time.time() - self.last >= self.period:
+            self.summarize()
+        return keep
+
+    def summarize(self):
+        skipped, self.skipped = self.skipped, {}
+        self.last = time.time()
+        if skipped:
+            self.summary(skipped)
+
+    def summary(self, skipped):
+        '''
+        Give the reporter how many violations were not reported per site,
+        as a Skipped each. skipped maps (code, line, sink) to that count.
+        '''
+        for (code, lno, sink), n in sorted(skipped.iteritems()):
+            reporter.report(Skipped(code, lno,
+                                    getattr(sink, '__name__', sink), n))
+
+
+reporter = StreamReporter()
+atexit.register(lambda: reporter.flush())
+
+
+def reached(t, v=None, sink=None):
     '''
     Execute if a tainted value reaches a sensitive sink
     for the vulnerability v.
@@ -309,24 +1413,23 @@ def reached(t, v=None):
     executed and the reached function is executed instead. If ENDS is set to False,
     the reached function is executed but the program continues its flow.
 
-    The provided de facto implementation alerts that the violation happened and
-    information to find the error.
-    '''
-    frame = sys._getframe(3)
-    filename = inspect.getfile(frame)
-    lno = frame.f_lineno
-    print "=" * 79
-    print "Violation in line %d from file %s" % (lno, filename)
-    # Localize this message
-    print "Tainted value: %s" % t
-    print '-' * 79
-    lineas = inspect.findsource(frame)[0]
-    lineas = ['    %s' % l for l in lineas]
-    lno = lno - 1
-    lineas[lno] = '--> ' + lineas[lno][4:]
-    lineas = lineas[lno - 3: lno + 3]
-    print "".join(lineas)
-    print "=" * 79
+    The provided de facto implementation gives a Violation, with the
+    information to find the error, to the module-level reporter.
+    '''
+    reporter.report(Violation(t, caller(1), v, sink))
+
+
+def caller(depth=0):
+    '''
+    Return the frame of the function calling, depth frames up or more:
+    frames of this module and of hidden_modules are skipped.
+    '''
+    frame = sys._getframe(depth + 1)
+    g = globals()
+    while frame.f_back and (frame.f_globals is g or
+                            frame.f_globals.get('__name__') in hidden_modules):
+        frame = frame.f_back
+    return frame
 
 def ssink(v=None, reached=reached):
     '''
@@ -335,6 +1438,8 @@ def ssink(v=None, reached=reached):
     If it is called with a value with the v tag
     (or any tag if v is None),
     it's not executed and reached is executed instead.
+    When SAMPLER is set, reached is only executed for the violations it
+    samples, the sink is still not executed for the rest.
 
     These sinks are sensitive to a kind of vulnerability, and must be specified when
     the decorator is used
@@ -365,37 +1470,75 @@ def ssink(v=None, reached=reached):
     def very_sensitive(input):
        ...
 
+    The undecorated function is kept as the trusted attribute of the sink,
+    for call sites known to never get tainted values (see
+    wrapstrings/cleanpaths.py).
     '''
-    def _solve(a, f, args, kwargs):
+    def _solve(a, f, args, kwargs, extra):
+        # ENDS and RAISES apply to every violation, sampled or not
+        if SAMPLER is not None and not SAMPLER.sample(caller(1), f):
+            if ENDS:
+                if RAISES:
+                    raise TaintException()
+                return None
+            return f(*args, **kwargs)
         if ENDS:
             if RAISES:
-                reached(a)
+                reached(a, *extra)
                 raise TaintException()
             else:
-                return reached(a)
+                return reached(a, *extra)
         else:
-            reached(a)
+            reached(a, *extra)
             return f(*args, **kwargs)
 
+    check = sink_checker(v)
+    default = reached is globals()['reached']
+
     def _ssink(f):
+        if not ENABLED:
+            return f
+        # the default reached also gets the tag and the name of the sink
+        extra = (v, getattr(f, '__name__', None)) if default else ()
+
         def inner(*args, **kwargs):
-            allargs = chain(args, kwargs.itervalues())
-            if v is None:   # sensitive to ALL
-                for a in allargs:
-                    t = set()
-                    collect_tags(a, t)
-                    if t:
-                        return _solve(a, f, args, kwargs)
-            else:
-                for a in allargs:
-                    t = set()
-                    collect_tags(a, t)
-                    if v in t:
-                        return _solve(a, f, args, kwargs)
+            for a in args:
+                if check(a):
+                    return _solve(a, f, args, kwargs, extra)
+            if kwargs:
+                for a in kwargs.itervalues():
+                    if check(a):
+                        return _solve(a, f, args, kwargs, extra)
             return f(*args, **kwargs)
-        return inner
+        inner.trusted = f
+        return profiled('ssink', qualified_name(f), named(inner, f))
     return _ssink
 
+
+def sink_checker(v=None):
+    '''
+    Return a function telling if a value is tainted for the vulnerability v
+    (or any vulnerability if v is None).
+
+    The bitmask to look for is computed once, and containers are walked
+    only until the first value carrying it is found.
+    '''
+    if v is None:   # sensitive to ALL
+        b = -1
+    else:
+        b = tag_bit(v)
+
+    def check(a):
+        if type(a) in untainted_types:
+            return False
+        l = getattr(a, '_taint_label', None)
+        if l is None:
+            if not isinstance(a, containers):
+                return False
+            l = collect_tags(a, b)
+        return l.mask & b
+    return check
+
 def tainted(o, v=None):
     '''
     Tells if a value o, a tclass instance, is tainted for the given
@@ -422,11 +1565,10 @@ def tainted(o, v=None):
     >>> tainted(t2)
     True
     '''
-    if not hasattr(o, 'taints'):
-        return False
+    l = getattr(o, '_taint_label', EMPTY)
     if v is not None:
-        return v in o.taints
-    return bool(o.taints)
+        return v in l
+    return bool(l)
 
 def taint(o, v=None):
     '''
@@ -463,73 +1605,401 @@ def taint(o, v=None):
     False
 
     '''
-    ts = set()
+    if not ENABLED:
+        return o
     if v is not None:
-        ts.add(v)
+        t = EMPTY.add(v)
     else:
-        ts.update(TAGS)
+        t = label_of(TAGS)
 
-    return taint_aware(o, ts)
+    return taint_aware(o, t)
 
 # ------------------------- Taint-aware classes -------------------------------
 
+_missing = object()
+
+
+def wrap_result(r, t, inplace=True):
+    '''
+    Return the result r of a propagated operation tainted with t.
+
+    Results of a supported builtin type are wrapped directly; only
+    containers (or already taint-aware results) go through taint_aware.
+    Containers are tainted in place, as builtin methods return new ones;
+    pass inplace=False if r may be shared.
+    '''
+    k = dispatch[type(r)]
+    if k is not None:
+        return k._make(r, t)
+    if isinstance(r, containers) or hasattr(r, '_taint_label'):
+        return taint_aware(r, t, inplace)
+    return r
+
+
 def propagate_method(method):
     def inner(self, *args, **kwargs):
         r = method(self, *args, **kwargs)
-        t = set()
+        t = self._taint_label
         for a in args:
-            collect_tags(a, t)
+            t |= collect_tags(a)
         for v in kwargs.values():
-            collect_tags(v, t)
-        t.update(self.taints)
-        return taint_aware(r, t)
+            t |= collect_tags(v)
+        return wrap_result(r, t)
+    return inner
+
+
+def propagate_nullary(method):
+    '''Like propagate_method, for methods taking no arguments.'''
+    def inner(self):
+        return wrap_result(method(self), self._taint_label)
     return inner
 
 
+def propagate_unary(method):
+    '''Like propagate_method, for methods taking at most one argument.'''
+    def inner(self, a=_missing):
+        if a is _missing:
+            return wrap_result(method(self), self._taint_label)
+        if type(a) in untainted_types:
+            return wrap_result(method(self, a), self._taint_label)
+        return wrap_result(method(self, a),
+                           self._taint_label | collect_tags(a))
+    return inner
+
+
+def propagate_mutator(method):
+    '''
+    Like propagate_method, for methods storing their arguments in self
+    (i.e. bytearray.append): self is tainted with them too.
+    '''
+    def inner(self, *args):
+        r = method(self, *args)
+        t = self._taint_label
+        for a in args:
+            t |= collect_tags(a)
+        self._set_label(t)
+        return wrap_result(r, t)
+    return inner
+
+
+def propagate_iter(method):
+    '''Like propagate_method, for __iter__: every item is tainted.'''
+    def inner(self):
+        t = self._taint_label
+        for x in method(self):
+            yield wrap_result(x, t)
+    return inner
+
+
+def propagate_binary(method):
+    '''Like propagate_method, for methods taking one or two arguments.'''
+    def inner(self, a, b=_missing):
+        if b is _missing:
+            if type(a) in untainted_types:
+                return wrap_result(method(self, a), self._taint_label)
+            return wrap_result(method(self, a),
+                               self._taint_label | collect_tags(a))
+        return wrap_result(method(self, a, b),
+                           self._taint_label | collect_tags(a) | collect_tags(b))
+    return inner
+
+
+# String formatting only propagates the tags of the arguments it actually
+# uses: the keys named by a % format applied to a mapping, and the fields
+# named by a format string. The fields of each format string are parsed
+# once and cached.
+
+mod_spec = re.compile(r'%(?:\(([^)]*)\))?([#0 +-]*)(\*|\d+)?(?:\.(\*|\d*))?'
+                      r'[hlL]?(.)')
+
+format_cache = {}
+FORMAT_CACHE_SIZE = 512
+
+
+def plain_type(s):
+    return unicode if isinstance(s, unicode) else str
+
+
+def str_len(s):
+    '''Length of the string s, as a plain int even if s is taint-aware.'''
+    return plain_type(s).__len__(s)
+
+
+def mod_keys(fmt):
+    '''Return the mapping keys used by the % format fmt.'''
+    try:
+        return format_cache[('%', fmt)]
+    except KeyError:
+        pass
+    keys = tuple(m.group(1) for m in mod_spec.finditer(plain_type(fmt)(fmt))
+                 if m.group(1) is not None)
+    if format_cache.__len__() >= FORMAT_CACHE_SIZE:
+        format_cache.clear()
+    format_cache[('%', fmt)] = keys
+    return keys
+
+
+def format_fields(fmt):
+    '''
+    Return the fields used by the format string fmt, as (first, rest) pairs
+    where first is the index or name of the argument and rest the
+    attributes and items looked up on it, in _formatter_field_name_split
+    form.
+    '''
+    try:
+        return format_cache[('{', fmt)]
+    except KeyError:
+        pass
+    k = plain_type(fmt)
+    fields = []
+    auto = [0]
+
+    def parse(f):
+        for literal, name, spec, conversion in k._formatter_parser(f):
+            if name is None:
+                continue
+            first, rest = k._formatter_field_name_split(name)
+            if first == '':
+                first = auto[0]
+                auto[0] += 1
+            fields.append((first, tuple(rest)))
+            if spec:
+                parse(spec)     # nested fields, i.e. '{0:{1}}'
+
+    parse(k(fmt))
+    fields = tuple(fields)
+    if format_cache.__len__() >= FORMAT_CACHE_SIZE:
+        format_cache.clear()
+    format_cache[('{', fmt)] = fields
+    return fields
+
+
+def mod_label(fmt, args, t=EMPTY):
+    '''Return t plus the tags of the arguments used by fmt % args.'''
+    if isinstance(args, tuple):
+        for a in args:
+            if type(a) not in untainted_types:
+                t |= collect_tags(a)
+        return t
+    keys = mod_keys(fmt)
+    if keys:
+        for key in keys:
+            t |= collect_tags(args[key])
+        return t
+    return t | collect_tags(args)
+
+
+def format_label(fmt, args, kwargs, t=EMPTY):
+    '''Return t plus the tags of the fields used by fmt.format.'''
+    for first, rest in format_fields(fmt):
+        if isinstance(first, (int, long)):
+            o = args[first]
+        else:
+            o = kwargs[first]
+        owner = EMPTY
+        for is_attr, i in rest:
+            owner = getattr(o, '_taint_label', owner)
+            o = getattr(o, i) if is_attr else o[i]
+        if type(o) not in untainted_types:
+            t |= collect_tags(o)
+        else:
+            # plain attributes of a taint-aware value, i.e. {0.real}
+            t |= owner
+    return t
+
+
+def string_methods(klass, tklass):
+    '''
+    Add %, format, format_map and join to tklass, the tclass of a string
+    type.
+    '''
+
+    def __mod__(self, args):
+        r = klass.__mod__(self, args)
+        if r is NotImplemented:
+            return r
+        return wrap_result(r, mod_label(self, args, self._taint_label))
+
+    def __rmod__(self, other):
+        # str + unicode: unicode.__rmod__ returns NotImplemented
+        if not isinstance(other, basestring):
+            return NotImplemented
+        r = plain_type(other).__mod__(other, self)
+        return wrap_result(r, mod_label(other, self,
+                                        getattr(other, '_taint_label', EMPTY)))
+
+    def format(self, *args, **kwargs):
+        r = klass.format(self, *args, **kwargs)
+        return wrap_result(r, format_label(self, args, kwargs,
+                                           self._taint_label))
+
+    def format_map(self, mapping):
+        '''Like format(**mapping), but mapping is used as is.'''
+        r = string.Formatter().vformat(klass(self), (), mapping)
+        return wrap_result(r, format_label(self, (), mapping,
+                                           self._taint_label))
+
+    def join(self, iterable):
+        # one pass over the items, even if iterable is a generator
+        if type(iterable) not in (list, tuple):
+            iterable = list(iterable)
+        t = self._taint_label
+        for o in iterable:
+            if type(o) not in untainted_types:
+                t |= collect_tags(o)
+        return wrap_result(klass.join(self, iterable), t)
+
+    tklass.__mod__ = __mod__
+    tklass.__rmod__ = __rmod__
+    tklass.format = format
+    tklass.format_map = format_map
+    tklass.join = join
+
+
 def taint_class(klass, methods=None):
     if not methods:
         methods = attributes(klass)
+
+    # Instances of builtins like str have no __dict__, and their taint-aware
+    # versions don't get one either: the label is a class attribute, with one
+    # subclass of tklass per label (see variant). A tainted value then takes
+    # as much memory as a plain one. Classes whose instances already have a
+    # __dict__ keep the label in it.
+    by_class = not getattr(klass, '__dictoffset__', 1)
+    # mutable builtins like bytearray get their value in __init__
+    init = klass.__init__ if klass.__init__ != object.__init__ else None
+
     class tklass(klass):
+        if by_class:
+            __slots__ = ()
+
+        _taint_label = EMPTY
+
         def __new__(cls, *args, **kwargs):
             self = super(tklass, cls).__new__(cls, *args, **kwargs) #justificar analizar pq no init
-            self.taints = set()
 
             # if any of the arguments is tainted, taint the object aswell
 
+            t = cls._taint_label
             for a in args:      # this CHUNK of code appears at least 3 times, refactor later
-                collect_tags(a, self.taints)
+                t |= collect_tags(a)
             for v in kwargs.values():
-                collect_tags(v, self.taints)
+                t |= collect_tags(v)
+            self._set_label(t)
 
             return self
 
-        # support for assigment and taint change in classobj
-
-        def __setattr__(self, name, value):
-            if self.__dict__ and name in self.__dict__ and tainted(self.__dict__[name]):
-                for t in self.__dict__[name].taints:
-                    # if other field had it, keep it
-                    taintsets = [v.taints for k,v in self.__dict__.items() if not callable(v) and tainted(v) and k != name]
-                    if not any([t in x for x in taintsets]):
-                        self.taints.remove(t)
-
-            if self.__dict__ is not None:
-                self.__dict__[name] = value
-                if tainted(value):
-                    self.taints.update(value.taints)
-
-    d = klass.__dict__
-    for name, attr in [(m, d[m]) for m in methods]:
-        if inspect.ismethod(attr) or inspect.ismethoddescriptor(attr):
-            setattr(tklass, name, propagate_method(attr))
+        @classmethod
+        def _make(cls, o, l):
+            '''Return an instance for the plain value o labelled l.'''
+            if by_class:
+                self = klass.__new__(variant(l), o)
+                if init is not None:
+                    init(self, o)
+                return self
+            self = klass.__new__(cls, o)
+            if init is not None:
+                init(self, o)
+            if hasattr(o, '__dict__'):
+                self.__dict__.update(o.__dict__)
+            self._set_label(l)
+            return self
+
+        def _get_taints(self):
+            return TaintSet(self)
+
+        def _set_taints(self, ts):
+            self._set_label(label_of(ts))
+
+        taints = property(_get_taints, _set_taints)
+
+        if by_class:
+            def _set_label(self, l):
+                self.__class__ = variant(l)
+        else:
+            def _set_label(self, l):
+                self.__dict__['_taint_label'] = l
+
+            # support for assigment and taint change in classobj
+            #
+            # _taint_fields maps each tainted (non callable) field to the
+            # label it had when assigned, and _taint_counts each bit to the
+            # number of fields carrying it, so a tag is dropped from the
+            # object when the last field having it is overwritten.
+
+            def __setattr__(self, name, value):
+                if name == 'taints':
+                    self._set_taints(value)
+                    return
+
+                d = self.__dict__
+                fields = d.get('_taint_fields')
+                if fields is None:
+                    fields = d['_taint_fields'] = {}
+                    d['_taint_counts'] = {}
+                self._forget_field(name)
+                d[name] = value
+                l = getattr(value, '_taint_label', None)
+                if l:
+                    if not callable(value):
+                        fields[name] = l
+                        counts = d['_taint_counts']
+                        for b in bits(l.mask):
+                            counts[b] = counts.get(b, 0) + 1
+                    self._set_label(self._taint_label | l)
+
+            def __delattr__(self, name):
+                super(tklass, self).__delattr__(name)
+                self._forget_field(name)
+
+            def _forget_field(self, name):
+                fields = self.__dict__.get('_taint_fields')
+                l = fields and fields.pop(name, None)
+                if l:
+                    counts = self.__dict__['_taint_counts']
+                    gone = 0
+                    for b in bits(l.mask):
+                        counts[b] -= 1
+                        if not counts[b]:
+                            del counts[b]
+                            gone |= b
+                    if gone:
+                        self._set_label(label(self._taint_label.mask & ~gone))
+
+    variants = {EMPTY: tklass}
+
+    def variant(l):
+        '''Return the subclass of tklass for values labelled l.'''
+        try:
+            return variants[l]
+        except KeyError:
+            v = variants[l] = type(tklass)(tklass.__name__, (tklass,),
+                                           {'__slots__': (),
+                                            '_taint_label': l,
+                                            '__module__': tklass.__module__})
+            return v
+
+    mro = inspect.getmro(klass)
+    for name in methods:
+        attr = [c.__dict__[name] for c in mro if name in c.__dict__][0]
+        if isinstance(attr, classmethod_descriptor):
+            continue    # i.e. float.fromhex, not called on instances
+        if inspect.ismethoddescriptor(attr):
+            # builtin methods, their signature is known
+            propagate = propagators.get(name, propagate_method)
+        elif inspect.ismethod(attr):
+            propagate = propagate_method
+        else:
+            continue
+        setattr(tklass, name, profiled('method', '%s.%s' % (klass.__name__,
+                                                             name),
+                                       propagate(attr)))
     # str has no __radd__ method
     if '__add__' in methods and '__radd__' not in methods:
         setattr(tklass, '__radd__', lambda self, other:
                                     tklass.__add__(tklass(other), self))
-    # unicode __rmod__ returns NotImplemented
-    if klass == unicode:
-        setattr(tklass, '__rmod__', lambda self, other:
-                                    tklass.__mod__(tklass(other), self))
+    if issubclass(klass, basestring):
+        string_methods(klass, tklass)
     return tklass
 
 
@@ -537,6 +2007,44 @@ dont_override = set(['__repr__', '__cmp__', '__getattribute__', '__new__',
                      '__init__','__nonzero__', '__reduce__', '__reduce_ex__',
                      '__str__', '__int__', '__float__', '__unicode__'])
 
+# Builtin methods by number of arguments, so taint_class can wrap them without
+# the generic *args/**kwargs collection.
+
+nullary_methods = set(['__abs__', '__getnewargs__', '__hash__', '__hex__',
+    '__index__', '__invert__', '__len__', '__long__', '__neg__', '__oct__',
+    '__pos__', '__sizeof__', '__trunc__', '_formatter_parser',
+    'as_integer_ratio', 'bit_length', 'capitalize', 'conjugate', 'hex',
+    'is_integer', 'isalnum', 'isalpha', 'isdecimal', 'isdigit', 'islower',
+    'isnumeric', 'isspace', 'istitle', 'isupper', 'lower', 'swapcase',
+    'title', 'upper'])
+
+unary_methods = set(['__add__', '__and__', '__coerce__', '__contains__',
+    '__div__', '__divmod__', '__eq__', '__floordiv__', '__format__', '__ge__',
+    '__getitem__', '__gt__', '__le__', '__lshift__', '__lt__', '__mod__',
+    '__mul__', '__ne__', '__or__', '__radd__', '__rand__', '__rdiv__',
+    '__rdivmod__', '__rfloordiv__', '__rlshift__', '__rmod__', '__rmul__',
+    '__ror__', '__rrshift__', '__rshift__', '__rsub__', '__rtruediv__',
+    '__rxor__', '__sub__', '__truediv__', '__xor__',
+    '_formatter_field_name_split', 'expandtabs', 'join', 'lstrip',
+    'partition', 'rpartition', 'rstrip', 'splitlines', 'strip', 'zfill'])
+
+binary_methods = set(['__getslice__', '__pow__', '__rpow__', 'center',
+    'ljust', 'rjust'])
+
+# Methods of mutable builtins that store their arguments in the instance.
+
+mutator_methods = set(['__iadd__', '__setitem__', '__setslice__', 'append',
+    'extend', 'insert'])
+
+classmethod_descriptor = type(float.__dict__['fromhex'])
+
+propagators = {}
+propagators.update((m, propagate_nullary) for m in nullary_methods)
+propagators.update((m, propagate_unary) for m in unary_methods)
+propagators.update((m, propagate_binary) for m in binary_methods)
+propagators.update((m, propagate_mutator) for m in mutator_methods)
+propagators['__iter__'] = propagate_iter
+
 
 # ------- Taint-aware classes for strings, integers, floats, and unicode ------
 
@@ -548,21 +2056,766 @@ str_methods = attributes(str)
 unicode_methods = attributes(unicode)
 int_methods = attributes(int)
 float_methods = attributes(float)
+bytearray_methods = attributes(bytearray)
 
 STR = taint_class(str, str_methods)
 UNICODE = taint_class(unicode, unicode_methods)
 INT = taint_class(int, int_methods)
 FLOAT = taint_class(float, float_methods)
+BYTEARRAY = taint_class(bytearray, bytearray_methods)
+
+
+class MEMORYVIEW(object):
+    '''
+    Taint-aware memoryview.
+
+    memoryview can't be subclassed, so this wraps one. Slicing returns a new
+    MEMORYVIEW over the same memory, without copying it, sharing the label
+    of its parent. Reading items or converting with tobytes and tolist
+    gives taint-aware values. The raw memoryview, to pass to functions
+    expecting a buffer, is the view attribute.
+
+    >>> data = taint(bytearray('GET /index.html'), XSS)
+    >>> path = MEMORYVIEW(data)[4:]
+    >>> path.tobytes()
+    '/index.html'
+    >>> tainted(path.tobytes(), XSS)
+    True
+    '''
+    __slots__ = ('view', '_taint_label')
+
+    def __init__(self, o, l=None):
+        self.view = o.view if isinstance(o, MEMORYVIEW) else memoryview(o)
+        self._taint_label = collect_tags(o) if l is None else l
+
+    @classmethod
+    def _make(cls, o, l):
+        return cls(o, l)
+
+    def _set_label(self, l):
+        self._taint_label = l
+
+    def _get_taints(self):
+        return TaintSet(self)
+
+    def _set_taints(self, ts):
+        self._taint_label = label_of(ts)
+
+    taints = property(_get_taints, _set_taints)
+
+    def __getitem__(self, i):
+        r = self.view[i]
+        if isinstance(r, memoryview):
+            return MEMORYVIEW(r, self._taint_label)
+        return wrap_result(r, self._taint_label)
+
+    def __setitem__(self, i, v):
+        self.view[i] = v
+        self._taint_label |= collect_tags(v)
+
+    def __len__(self):
+        return self.view.__len__()
+
+    def __eq__(self, other):
+        if isinstance(other, MEMORYVIEW):
+            other = other.view
+        return self.view == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def tobytes(self):
+        return wrap_result(self.view.tobytes(), self._taint_label)
+
+    def tolist(self):
+        return wrap_result(self.view.tolist(), self._taint_label)
+
+    def __getattr__(self, name):
+        # format, itemsize, ndim, readonly, shape, strides
+        return getattr(self.view, name)
+
+    def __repr__(self):
+        return '<tainted %r>' % self.view
+
+
+tclasses = {str: STR, int: INT, float: FLOAT, unicode: UNICODE,
+            bytearray: BYTEARRAY, memoryview: MEMORYVIEW}
+
+
+def subclass_tclass(klass):
+    '''
+    Return a new tclass for klass, a subclass of one of the types in
+    tclasses, or None if its instances can't be made taint-aware.
+    '''
+    if klass is bool or hasattr(klass, '_taint_label'):
+        return None
+    if not any(issubclass(klass, b) for b in tclasses):
+        return None
+    for c in inspect.getmro(klass):
+        if c in tclasses:
+            break
+        if '__new__' in vars(c) or '__init__' in vars(c):
+            # _make builds instances from the plain value alone
+            return None
+    methods = set()
+    for c in inspect.getmro(klass):
+        if c is not object:
+            methods |= attributes(c)
+    return taint_class(klass, methods)
+
+
+class Dispatch(dict):
+    '''
+    Maps a type to the tclass for its instances, or to None if they can't
+    be made taint-aware. Unknown types are resolved with subclass_tclass on
+    first use, so a later lookup is a single dict hit.
+    '''
+
+    def __missing__(self, klass):
+        k = self[klass] = subclass_tclass(klass)
+        return k
 
-tclasses = {str: STR, int: INT, float: FLOAT, unicode: UNICODE}
+dispatch = Dispatch(tclasses)
 
 def tclass(o):
     '''Tainted instance factory.'''
-    klass = type(o)
-    if klass in tclasses.keys():
-        return tclasses[klass](o)
+    k = dispatch[type(o)]
+    if k is None:
+        raise KeyError(type(o))
+    return k._make(o, EMPTY)
+
+# ------------------------- Positional taint ----------------------------------
+# In positional mode strings carry the label of each of their characters,
+# run-length encoded as a tuple of (start, end, label) runs, sorted, with no
+# runs for untainted characters and adjacent runs merged when their labels
+# are the same. Concatenation, slicing, join, %, replace and split compute
+# the runs of their result from the runs of their operands, so they take
+# time proportional to the number of runs, not of characters. The rest of
+# the methods label the whole result, like STR and UNICODE do.
+
+
+def positional_taint(b=True):
+    '''
+    Turn positional mode on (or off): from now on, strings are made
+    taint-aware as PSTR or PUNICODE instead of STR or UNICODE.
+    '''
+    global POSITIONAL
+    POSITIONAL = b
+    dispatch[str] = PSTR if b else STR
+    dispatch[unicode] = PUNICODE if b else UNICODE
+
+
+def taint_ranges(o):
+    '''
+    Return the tainted characters of the string o, as a list of
+    (start, end, tags) tuples.
+
+    >>> positional_taint()
+    >>> q = "SELECT * FROM users WHERE name='" + taint('bob', SQLI) + "'"
+    >>> taint_ranges(q)
+    [(32, 35, set([2]))]
+    >>> taint_ranges(q.split("'")[1])
+    [(0, 3, set([2]))]
+    >>> positional_taint(False)
+    '''
+    return [(s, e, tags_of(l.mask)) for s, e, l in ranges_of(o)]
+
+
+def ranges_of(o, n=None):
+    '''Return the runs of o, a string of length n, taint-aware or not.'''
+    r = getattr(o, '_taint_ranges', None)
+    if r is not None:
+        return r
+    l = getattr(o, '_taint_label', EMPTY)
+    if n is None:
+        n = str_len(o)
+    return ((0, n, l),) if l and n else ()
+
+
+class Runs(object):
+    '''Runs of a string being built from left to right, piece by piece.'''
+    __slots__ = ('runs', 'pos')
+
+    def __init__(self):
+        self.runs = []
+        self.pos = 0
+
+    def run(self, s, e, l):
+        runs = self.runs
+        if not l or s >= e:
+            return
+        if runs and runs[-1][1] == s and runs[-1][2] is l:
+            runs[-1] = (runs[-1][0], e, l)
+        else:
+            runs.append((s, e, l))
+
+    def add(self, ranges, n, i=0):
+        '''Append the n characters starting at i of a string with ranges.'''
+        j = i + n
+        k = bisect.bisect_left(ranges, (i,))
+        if k:
+            k -= 1      # the run before may overlap i
+        for s, e, l in ranges[k:]:
+            if s >= j:
+                break
+            self.run(self.pos + max(s, i) - i, self.pos + min(e, j) - i, l)
+        self.pos += n
+
+    def uniform(self, n, l):
+        '''Append n characters labelled l.'''
+        self.run(self.pos, self.pos + n, l)
+        self.pos += n
+
+
+def positional(r, runs):
+    '''Return the string r as a PSTR or PUNICODE with the given runs.'''
+    k = PUNICODE if isinstance(r, unicode) else PSTR
+    return k._with_runs(r, tuple(runs))
+
+
+def mod_runs(fmt, args, r):
+    '''
+    Return the runs of r, the result of fmt % args.
+
+    Each conversion is formatted again on its own to learn where its
+    argument lands in r; string arguments formatted with %s keep their
+    own runs (shifted by the padding, truncated by the precision), any other
+    conversion is labelled as a whole with the tags of its argument. If
+    that doesn't rebuild r (odd formats), r is labelled as a whole.
+    '''
+    fruns = ranges_of(fmt)
+    if hasattr(fmt, '_taint_label'):
+        fmt = plain_type(fmt)(fmt)
+    if isinstance(args, tuple):
+        seq = iter(args)
+    else:
+        seq = iter((args,))
+    b = Runs()
+    pieces = []
+    last = 0
+    try:
+        for m in mod_spec.finditer(fmt):
+            start = m.start()
+            if start > last:
+                b.add(fruns, start - last, last)
+                pieces.append(fmt[last:start])
+            last = m.end()
+            key, flags, width, prec, conv = m.groups()
+            if conv == '%':
+                b.add(fruns, 1, start)
+                pieces.append('%')
+                continue
+            if width == '*':
+                width = str(seq.next())
+            if prec == '*':
+                prec = str(seq.next())
+            a = args[key] if key is not None else seq.next()
+            spec = '%' + flags + (width or '')
+            if prec is not None:
+                spec += '.' + prec
+            piece = (spec + conv) % (a,)
+            pn = piece.__len__()
+            pieces.append(piece)
+            if conv == 's' and isinstance(a, basestring):
+                an = str_len(a)
+                shown = an if prec is None else min(an, int(prec))
+                pad = 0 if '-' in flags else pn - shown
+                b.pos += pad
+                b.add(ranges_of(a, an), shown)
+                b.pos += pn - shown - pad
+            else:
+                b.uniform(pn, collect_tags(a))
+        if last < fmt.__len__():
+            b.add(fruns, fmt.__len__() - last, last)
+            pieces.append(fmt[last:])
+    except (StopIteration, KeyError, TypeError, ValueError, IndexError):
+        pieces = None
+    if pieces is None or ''.join(pieces) != r:
+        b = Runs()
+        b.uniform(r.__len__(), mod_label(fmt, args, collect_tags(fmt)))
+    return b.runs
+
+
+def positional_class(tklass):
+    '''
+    Return the positional version of tklass, the tclass of str or unicode.
+
+    Its instances have a __dict__, holding their runs and label.
+    '''
+    klass = tklass.__bases__[0]
+
+    class pklass(tklass):
+        _taint_ranges = ()
+
+        @classmethod
+        def _make(cls, o, l):
+            self = klass.__new__(cls, o)
+            n = klass.__len__(self)
+            self.__dict__['_taint_ranges'] = ((0, n, l),) if l and n else ()
+            self.__dict__['_taint_label'] = l
+            return self
+
+        @classmethod
+        def _with_runs(cls, o, runs):
+            self = klass.__new__(cls, o)
+            l = EMPTY
+            for s, e, rl in runs:
+                l |= rl
+            self.__dict__['_taint_ranges'] = runs
+            self.__dict__['_taint_label'] = l
+            return self
+
+        def _set_label(self, l):
+            # tags removed are removed from every character, tags added
+            # are added to every character
+            d = self.__dict__
+            old = d.get('_taint_label', EMPTY)
+            keep = l.mask
+            added = l.mask & ~old.mask
+            n = klass.__len__(self)
+            b = Runs()
+            for s, e, rl in d.get('_taint_ranges', ()):
+                if added:
+                    b.run(b.pos, s, label(added))
+                b.run(s, e, label((rl.mask & keep) | added))
+                b.pos = e
+            if added:
+                b.run(b.pos, n, label(added))
+            d['_taint_ranges'] = tuple(b.runs)
+            d['_taint_label'] = l
+
+        def __add__(self, other):
+            r = klass.__add__(self, other)
+            if r is NotImplemented:
+                return r
+            n = klass.__len__(self)
+            b = Runs()
+            b.add(self._taint_ranges, n)
+            b.add(ranges_of(other), r.__len__() - n)
+            return positional(r, b.runs)
+
+        def __radd__(self, other):
+            if not isinstance(other, basestring):
+                return NotImplemented
+            r = other + klass(self)
+            n = str_len(other)
+            b = Runs()
+            b.add(ranges_of(other, n), n)
+            b.add(self._taint_ranges, r.__len__() - n)
+            return positional(r, b.runs)
+
+        def __getitem__(self, i):
+            r = klass.__getitem__(self, i)
+            n = klass.__len__(self)
+            b = Runs()
+            if not isinstance(i, slice):
+                if i < 0:
+                    i += n
+                b.add(self._taint_ranges, 1, i)
+            else:
+                start, stop, step = i.indices(n)
+                if step == 1:
+                    b.add(self._taint_ranges, r.__len__(), start)
+                else:
+                    for j in xrange(start, stop, step):
+                        b.add(self._taint_ranges, 1, j)
+            return positional(r, b.runs)
+
+        def __getslice__(self, i, j):
+            n = klass.__len__(self)
+            i = max(0, min(i, n))
+            j = max(i, min(j, n))
+            b = Runs()
+            b.add(self._taint_ranges, j - i, i)
+            return positional(klass.__getslice__(self, i, j), b.runs)
+
+        def join(self, iterable):
+            items = list(iterable)
+            r = klass.join(self, items)
+            n = klass.__len__(self)
+            b = Runs()
+            for k, o in enumerate(items):
+                if k:
+                    b.add(self._taint_ranges, n)
+                b.add(ranges_of(o), str_len(o))
+            return positional(r, b.runs)
+
+        def __mod__(self, args):
+            r = klass.__mod__(self, args)
+            if r is NotImplemented:
+                return r
+            return positional(r, mod_runs(self, args, r))
+
+        def __rmod__(self, other):
+            if not isinstance(other, basestring):
+                return NotImplemented
+            r = other % klass(self)
+            return positional(r, mod_runs(other, self, r))
+
+        def replace(self, old, new, count=-1):
+            r = klass.replace(self, old, new, count)
+            if not old:
+                # new goes between every character
+                b = Runs()
+                b.uniform(r.__len__(), self._taint_label | collect_tags(new))
+                return positional(r, b.runs)
+            on = str_len(old)
+            nn = str_len(new)
+            nruns = ranges_of(new, nn)
+            b = Runs()
+            pos = 0
+            while count:
+                k = klass.find(self, old, pos)
+                if k < 0:
+                    break
+                b.add(self._taint_ranges, k - pos, pos)
+                b.add(nruns, nn)
+                pos = k + on
+                count -= 1
+            b.add(self._taint_ranges, klass.__len__(self) - pos, pos)
+            return positional(r, b.runs)
+
+        def split(self, sep=None, maxsplit=-1):
+            pieces = []
+            pos = 0
+            for piece in klass.split(self, sep, maxsplit):
+                if sep is None:
+                    # whitespace can't hold the text of a piece
+                    pos = klass.find(self, piece, pos)
+                n = piece.__len__()
+                b = Runs()
+                b.add(self._taint_ranges, n, pos)
+                pieces.append(positional(piece, b.runs))
+                pos += n
+                if sep is not None:
+                    pos += str_len(sep)
+            return pieces
+
+    return pklass
+
+
+PSTR = positional_class(STR)
+PUNICODE = positional_class(UNICODE)
+
+
+class StringBuilder(object):
+    '''
+    Builds a taint-aware string from pieces, like StringIO.
+
+    Only the tags (or in positional mode, the runs) of each piece are kept
+    as it is written; the string is joined and made taint-aware once, by
+    getvalue. Use it instead of repeated += over tainted strings, or
+    instead of ''.join(pieces), which loses the taints of the pieces
+    unless the separator is taint-aware.
+
+    >>> b = StringBuilder()
+    >>> b.write('rm ')
+    >>> b.write(taint('-rf /', OSI))
+    >>> v = b.getvalue()
+    >>> v
+    'rm -rf /'
+    >>> v.taints
+    set([3])
+    '''
+
+    def __init__(self, buf=''):
+        self.pieces = []
+        self.label = EMPTY
+        self.runs = Runs()
+        if buf:
+            self.write(buf)
+
+    def write(self, s):
+        l = getattr(s, '_taint_label', EMPTY)
+        if not isinstance(s, basestring):
+            s = dispatch[str]._make(str(s), l) if l else str(s)
+        n = str_len(s)
+        if l:
+            self.label |= l
+        if l and POSITIONAL:
+            self.runs.add(ranges_of(s, n), n)
+        else:
+            self.runs.pos += n
+        self.pieces.append(s)
+
+    def writelines(self, iterable):
+        for s in iterable:
+            self.write(s)
+
+    def tell(self):
+        return self.runs.pos
+
+    def __len__(self):
+        return self.runs.pos
+
+    def getvalue(self):
+        r = ''.join(self.pieces)
+        if POSITIONAL:
+            return positional(r, self.runs.runs)
+        return dispatch[type(r)]._make(r, self.label)
+
+    def close(self):
+        self.pieces = None
+
+# ------------------------- Batches -------------------------------------------
+# A Column keeps a sequence of values and, apart, the label of each one as a
+# bitmask in an array: a numpy uint64 array if numpy is available, or else
+# an array.array. Tainting, checking and cleaning a whole column are then
+# single operations over that array instead of a loop over taint-aware
+# values.
+
+FULL_MASK = (1 << 64) - 1
+
+
+def mask_array(n, m):
+    '''Return an array of n bitmasks m.'''
+    if numpy is not None:
+        return numpy.full(n, m, dtype=numpy.uint64)
+    return array.array('L', [m]) * n
+
+
+def masks_of(values):
+    '''Return the array of the bitmasks of the labels of values.'''
+    ms = [collect_tags(x).mask for x in values]
+    if numpy is not None:
+        return numpy.array(ms, dtype=numpy.uint64)
+    return array.array('L', ms)
+
+
+def masks_or(masks):
+    '''Return the union of the bitmasks in masks.'''
+    if numpy is not None and isinstance(masks, numpy.ndarray):
+        return int(numpy.bitwise_or.reduce(masks)) if masks.size else 0
+    return reduce(operator.or_, masks, 0)
+
+
+def masks_test(masks, b):
+    '''Return which bitmasks in masks have any of the bits b.'''
+    if numpy is not None and isinstance(masks, numpy.ndarray):
+        return (masks & numpy.uint64(b)) != 0
+    return [bool(m & b) for m in masks]
+
+
+def masks_union(a, b):
+    '''Return the bitmasks of a or'ed with those of b, one by one.'''
+    if numpy is not None and isinstance(a, numpy.ndarray):
+        return a | b
+    return array.array('L', [x | y for x, y in zip(a, b)])
+
+
+def masks_concat(ms):
+    '''Return the concatenation of the arrays of bitmasks ms.'''
+    if numpy is not None:
+        return numpy.concatenate([numpy.asarray(m, dtype=numpy.uint64)
+                                  for m in ms])
+    r = array.array('L')
+    for m in ms:
+        r.extend(m)
+    return r
+
+
+def masks_relabel(masks, keep, added=0):
+    '''Return masks with only the bits in keep, plus the bits in added.'''
+    if numpy is not None and isinstance(masks, numpy.ndarray):
+        return (masks & numpy.uint64(keep)) | numpy.uint64(added)
+    return array.array('L', [(m & keep) | added for m in masks])
+
+
+class Column(object):
+    '''
+    A sequence of values, with the label of each value in an array.
+
+    The label of the column itself is the union of those of its values, so
+    sinks, cleaners and validators take columns like any other taint-aware
+    value: a sink is reached if any value is tainted, and a cleaner cleans
+    them all. Reading a single value gives it taint-aware, with its own
+    label; slicing gives a column.
+
+    >>> c = taint_many(['1', '2 or 1=1'], SQLI)
+    >>> tainted(c, SQLI)
+    True
+    >>> c = clean_many(c, SQLI)
+    >>> tainted(c[1], SQLI)
+    False
+    '''
+    __slots__ = ('values', 'masks')
+
+    def __init__(self, values, masks=None):
+        self.values = values
+        if masks is None:
+            if numpy is not None and isinstance(values, numpy.ndarray) and \
+               values.dtype != object:
+                # one label per row, as __len__ and __getitem__ count them
+                masks = mask_array(values.__len__(), 0)
+            else:
+                masks = masks_of(values)
+        self.masks = masks
+
+    @classmethod
+    def _make(cls, o, l):
+        if isinstance(o, Column):
+            return cls(o.values, masks_relabel(o.masks, FULL_MASK, l.mask))
+        return cls(o, mask_array(o.__len__(), l.mask))
+
+    def _get_label(self):
+        return label(masks_or(self.masks))
+
+    _taint_label = property(_get_label)
+
+    def _set_label(self, l):
+        # tags removed are removed from every value, tags added are added
+        # to every value
+        old = self._taint_label.mask
+        self.masks = masks_relabel(self.masks, l.mask, l.mask & ~old)
+
+    def _get_taints(self):
+        return TaintSet(self)
+
+    def _set_taints(self, ts):
+        self._set_label(label_of(ts))
+
+    taints = property(_get_taints, _set_taints)
+
+    def __len__(self):
+        return self.values.__len__()
+
+    def __getitem__(self, i):
+        # pandas objects are indexed by position through iloc
+        values = getattr(self.values, 'iloc', self.values)
+        if isinstance(i, slice):
+            return Column(values[i], self.masks[i])
+        x = values[i]
+        l = label(int(self.masks[i]))
+        if hasattr(x, '_taint_label'):
+            # a copy, the value in the column keeps its own label
+            return type(x)._make(x, l)
+        return wrap_result(x, l, False)
+
+    def __iter__(self):
+        for i in xrange(self.__len__()):
+            yield self[i]
+
+    def __repr__(self):
+        return 'Column(%r)' % (self.values,)
+
+
+def vectorised(values):
+    '''Tell if operators on values already work element by element.'''
+    return (numpy is not None and isinstance(values, numpy.ndarray) or
+            pandas is not None and isinstance(values, pandas.Series))
+
+
+def column_binary(op, reflected=False):
+    '''
+    Return the Column method applying op element by element, with the
+    labels of both operands or'ed value by value.
+    '''
+    def inner(self, other):
+        if isinstance(other, Column):
+            o, masks = other.values, masks_union(self.masks, other.masks)
+        else:
+            o = other
+            masks = masks_relabel(self.masks, FULL_MASK,
+                                  collect_tags(other).mask)
+        a, b = (o, self.values) if reflected else (self.values, o)
+        if vectorised(self.values):
+            r = op(a, b)
+        elif isinstance(other, Column):
+            r = [op(x, y) for x, y in zip(a, b)]
+        elif reflected:
+            r = [op(a, y) for y in b]
+        else:
+            r = [op(x, b) for x in a]
+        return Column(r, masks)
+    return inner
+
+
+def column_unary(op):
+    '''Return the Column method applying op element by element.'''
+    def inner(self):
+        if vectorised(self.values):
+            return Column(op(self.values), self.masks)
+        return Column([op(x) for x in self.values], self.masks)
+    return inner
+
+
+for _name in ['add', 'sub', 'mul', 'div', 'truediv', 'floordiv', 'mod',
+              'pow', 'and', 'or', 'xor', 'lshift', 'rshift']:
+    _op = getattr(operator, '__%s__' % _name)
+    setattr(Column, '__%s__' % _name, column_binary(_op))
+    setattr(Column, '__r%s__' % _name, column_binary(_op, True))
+for _name in ['lt', 'le', 'eq', 'ne', 'gt', 'ge']:
+    setattr(Column, '__%s__' % _name,
+            column_binary(getattr(operator, '__%s__' % _name)))
+for _name in ['neg', 'pos', 'abs', 'invert']:
+    setattr(Column, '__%s__' % _name,
+            column_unary(getattr(operator, '__%s__' % _name)))
+Column.__hash__ = None
+
+
+def concatenate(columns):
+    '''
+    Return the Column with the values of columns, one after the other,
+    each keeping its label. Plain sequences are taken as untainted columns.
+    '''
+    columns = [c if isinstance(c, Column) else Column(c) for c in columns]
+    values = [c.values for c in columns]
+    if numpy is not None and all(isinstance(v, numpy.ndarray)
+                                 for v in values):
+        r = numpy.concatenate(values)
+    elif pandas is not None and all(isinstance(v, pandas.Series)
+                                    for v in values):
+        r = pandas.concat(values)
     else:
-        raise KeyError
+        r = []
+        for v in values:
+            r.extend(v)
+    return Column(r, masks_concat([c.masks for c in columns]))
+
+
+# Arrays (and pandas series) returned by untrusted sources become columns.
+if numpy is not None:
+    dispatch[numpy.ndarray] = Column
+if pandas is not None:
+    dispatch[pandas.Series] = Column
+
+
+def taint_many(values, v=None):
+    '''
+    Return a Column with values, each one tainted with the vulnerability v
+    (or all of them if v is None), plus the tags it already had.
+    '''
+    t = label_of(TAGS) if v is None else EMPTY.add(v)
+    if isinstance(values, Column):
+        return Column._make(values, t)
+    c = Column(values)
+    c.masks = masks_relabel(c.masks, FULL_MASK, t.mask)
+    return c
+
+
+def tainted_mask(values, v=None):
+    '''
+    Tell, for each value in values, if it is tainted with the vulnerability
+    v (or any if v is None): a numpy bool array for a Column if numpy is
+    available, else a list.
+    '''
+    if not isinstance(values, Column):
+        return [tainted(x, v) for x in values]
+    return masks_test(values.masks, FULL_MASK if v is None else tag_bit(v))
+
+
+def clean_many(values, v, f=None):
+    '''
+    Return a Column with values, cleaned for the vulnerability v. If f is
+    given it is applied to each value first, as the cleaner function.
+    '''
+    if not isinstance(values, Column):
+        values = Column(values)
+    masks = masks_relabel(values.masks, FULL_MASK ^ tag_bit(v))
+    if f is None:
+        return Column(values.values, masks)
+    return Column([f(x) for x in values.values], masks)
+
 
 if __name__ == "__main__":
         import doctest
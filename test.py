@@ -22,6 +22,12 @@ along with taintmode.py.  If not, see <http://www.gnu.org/licenses/>.
 
 '''
 from taintmode import *
+import taintmode
+import json
+import os
+import StringIO
+import subprocess
+import sys
 import unittest
 
 ends_execution()
@@ -533,6 +539,34 @@ class TestSTR(unittest.TestCase):
         i = some_input("cinco")
         self.assertFalse(saveDB2(len(i)))
 
+    def test_propagate_func_copies(self):
+        '''the result of a propagated function is tainted, not its input.'''
+
+        shared = ['a']
+        r = taintmode.propagate_func(lambda s, l: l)(taint('q'), shared)
+        self.assertTrue(tainted(r[0]))
+        self.assertFalse(tainted(shared[0]))
+
+    def test_argument_taints(self):
+        '''if an argument is tainted, the result is also tainted.'''
+
+        x = taint('*', XSS)
+        self.assertTrue(tainted(STR('abc').center(9, x), XSS))
+        self.assertTrue(tainted(STR('abc').strip(x), XSS))
+        self.assertTrue(tainted(STR('-').join(['a', x]), XSS))
+        self.assertTrue(tainted(STR('abc').replace('b', x), XSS))
+
+    def test_wrapped_types(self):
+        '''results keep being taint-aware instances of the right type.'''
+
+        i = some_input('wrapped types')
+        self.assertTrue(isinstance(i.upper(), STR))
+        self.assertTrue(isinstance(i[1:3], STR))
+        self.assertTrue(isinstance(i.find('t'), INT))
+        for x in i.split():
+            self.assertTrue(isinstance(x, STR))
+        self.assertEqual(bool, type(i.startswith('w')))
+
 class TestINT(unittest.TestCase):
 
     def test_abs(self):
@@ -572,6 +606,12 @@ class TestINT(unittest.TestCase):
         i = some_input(1)
         self.assertTrue(tainted(2 + i))
 
+    def test_pow_mod(self):
+        i = some_input(2)
+        self.assertEqual(3, pow(i, 3, 5))
+        self.assertTrue(tainted(pow(i, 3, 5)))
+        self.assertTrue(tainted(pow(taint(3, XSS), 2, 5), XSS))
+
 class TestFLOAT(unittest.TestCase):
 
     def test_abs(self):
@@ -658,6 +698,166 @@ class TestDict(unittest.TestCase):
         d = retorna_dict()
         self.assertTrue(tainted(d['a']))
 
+class TestTraversal(unittest.TestCase):
+
+    def test_deep(self):
+        d = 'deep'
+        for n in range(5000):
+            d = [d]
+        t = taint(d)
+        for n in range(5000):
+            t = t[0]
+        self.assertTrue(tainted(t))
+        self.assertFalse(taintmode.collect_tags(d))
+        self.assertTrue(taintmode.collect_tags(taint(d)))
+
+    def test_cycle(self):
+        a = ['cycle']
+        a.append(a)
+        d = {'a': a}
+        d['d'] = d
+        t = taint(d)
+        self.assertTrue(tainted(t['a'][0]))
+        self.assertTrue(t['a'][1] is t['a'])
+        self.assertTrue(t['d'] is t)
+
+    def test_aliasing(self):
+        shared = ['shared']
+        t = taint((shared, shared, {1: shared}))
+        self.assertTrue(t[0] is t[1])
+        self.assertTrue(t[0] is t[2][1])
+        self.assertFalse(t[0] is shared)
+
+    def test_tuple_in_cycle(self):
+        a = []
+        a.append(('in tuple', a))
+        t = taint(a)
+        self.assertTrue(tainted(t[0][0]))
+        self.assertTrue(t[0][1] is t)
+
+    def test_reuse_when_aware(self):
+        l = [taint('cow a'), (taint('cow b'), 1.5)]
+        l[1] = (l[1][0], taint(1.5))
+        t = taint(l, XSS)
+        self.assertTrue(t is l)
+        self.assertTrue(t[1] is l[1])
+
+    def test_copy_when_converted(self):
+        inner = (taint('cow untouched'),)
+        l = [inner, ['cow converted']]
+        t = taint(l)
+        self.assertFalse(t is l)
+        self.assertTrue(t[0] is inner)
+        self.assertFalse(tainted(l[1][0]))
+        self.assertTrue(tainted(t[1][0]))
+
+    def test_inplace(self):
+        class Storage(dict):
+            pass
+        d = Storage(a=['inplace a'], b=('inplace b',))
+        a = d['a']
+        t = taintmode.taint_aware(d, taintmode.label_of(taintmode.TAGS), True)
+        self.assertTrue(t is d)
+        self.assertTrue(t['a'] is a)
+        self.assertTrue(tainted(a[0]))
+        self.assertTrue(tainted(t['b'][0]))
+
+    def test_inplace_untrusted(self):
+        d = {'a': 'inplace untrusted'}
+        u = untrusted(lambda: d, inplace=True)()
+        self.assertTrue(u is d)
+        self.assertTrue(tainted(d['a']))
+
+    def test_max_depth(self):
+        taintmode.MAX_DEPTH = 2
+        try:
+            self.assertTrue(tainted(taint([['ok']])[0][0]))
+            self.assertRaises(taintmode.TaintException, taint, [[['too deep']]])
+            self.assertRaises(taintmode.TaintException, saveDB1, [[['too deep']]])
+        finally:
+            taintmode.MAX_DEPTH = None
+
+
+class TestCollectTags(unittest.TestCase):
+
+    def test_nested(self):
+        i = some_input('collect nested')
+        l = taintmode.collect_tags({'a': ['x', ('y', i)]})
+        self.assertTrue(SQLI in l)
+
+    def test_not_tainted(self):
+        l = taintmode.collect_tags({'a': ['x', ('y', 'z')]})
+        self.assertFalse(l)
+
+    def test_cycle(self):
+        i = some_input('collect cycle')
+        a = ['x']
+        a.append(a)
+        self.assertTrue(saveDB2(a))
+        a.append({'k': i})
+        self.assertFalse(saveDB2(a))
+
+    def test_stop(self):
+        a = taint('stop a', XSS)
+        b = taint('stop b', SQLI)
+        bit = taintmode.tag_bit(XSS)
+        self.assertEqual(set([XSS]), set(taintmode.collect_tags([a, b], bit)))
+        self.assertEqual(set([XSS, SQLI]), set(taintmode.collect_tags([a, b])))
+
+
+class TestSubclasses(unittest.TestCase):
+
+    def test_str_subclass(self):
+        class Name(str):
+            def shout(self):
+                return self.upper() + '!'
+        n = some_input(Name('subclass'))
+        self.assertTrue(tainted(n))
+        self.assertTrue(isinstance(n, Name))
+        self.assertTrue(tainted(n.shout()))
+        self.assertTrue(tainted(n + 'x'))
+        self.assertFalse(saveDB2(n))
+
+    def test_int_subclass(self):
+        class Port(int):
+            pass
+        p = some_input([Port(80)])[0]
+        self.assertTrue(isinstance(p, Port))
+        self.assertTrue(tainted(p + 1))
+
+    def test_same_tclass(self):
+        class Name(str):
+            pass
+        a = some_input(Name('same a'))
+        b = some_input(Name('same b'))
+        self.assertTrue(type(a) is type(b))
+        self.assertTrue(taintmode.dispatch[Name] is taintmode.tclass(Name('c')).__class__)
+
+    def test_attributes_kept(self):
+        class Name(str):
+            pass
+        n = Name('attributes')
+        n.lang = 'en'
+        self.assertEqual('en', some_input(n).lang)
+
+    def test_own_constructor(self):
+        class Pair(str):
+            def __new__(cls, a, b):
+                return str.__new__(cls, a + b)
+        class Tagged(int):
+            def __init__(self, v, tag=None):
+                self.tag = tag
+        p = Pair('a', 'b')
+        self.assertTrue(some_input(p) is p)
+        self.assertTrue(taint(p) is p)
+        t = Tagged(1)
+        self.assertTrue(some_input([t])[0] is t)
+
+    def test_bool(self):
+        self.assertFalse(tainted(some_input(True)))
+        self.assertFalse(tainted(some_input([None])[0]))
+
+
 class TestCHR(unittest.TestCase):
     '''Test the chr built-it function. If the int-like argument is tainted,
      the returned string must be tainted too.'''
@@ -717,6 +917,109 @@ class TestTaints(unittest.TestCase):
         self.assertFalse(XSS in n.taints)
 
 
+class TestLabels(unittest.TestCase):
+
+    def test_label_is_mask(self):
+        n = taint('label is mask', XSS)
+        self.assertEqual(taintmode.tag_bit(XSS), n._taint_label.mask)
+
+    def test_labels_are_shared(self):
+        a = some_input('labels are shared a')
+        b = some_input('labels are shared b')
+        self.assertTrue(a._taint_label is b._taint_label)
+        self.assertTrue(cleanSQLI(a)._taint_label is
+                        cleanSQLI(b)._taint_label)
+
+    def test_label_transitions(self):
+        l = taintmode.label_of([XSS])
+        self.assertTrue(l | taintmode.label_of([SQLI]) is
+                        taintmode.label_of([XSS, SQLI]))
+        self.assertTrue(l.discard(XSS) is taintmode.EMPTY)
+        self.assertTrue(l.add(XSS) is l)
+
+    def test_union(self):
+        a = taint('union a', XSS)
+        b = taint('union b', SQLI)
+        self.assertEqual(set([XSS, SQLI]), (a + b).taints)
+
+    def test_view_add_discard(self):
+        n = taint('view add discard', XSS)
+        n.taints.add(OSI)
+        self.assertTrue(tainted(n, OSI))
+        n.taints.discard(XSS)
+        self.assertFalse(tainted(n, XSS))
+        self.assertEqual(set([OSI]), n.taints)
+
+    def test_view_set_methods(self):
+        n = taint('view set methods', XSS)
+        self.assertEqual(set([XSS, SQLI]), n.taints | set([SQLI]))
+        self.assertEqual(set(), n.taints & set([SQLI]))
+        self.assertEqual(set([XSS, II]), n.taints.union([II]))
+        c = n.taints.copy()
+        c.add(OSI)
+        self.assertFalse(tainted(n, OSI))
+        n.taints.update([SQLI], set([II]))
+        self.assertEqual(set([XSS, SQLI, II]), n.taints)
+
+    def test_assign_taints(self):
+        n = taint('assign taints')
+        n.taints = set([II])
+        self.assertEqual(set([II]), n.taints)
+
+    def test_new_tag(self):
+        n = taint('new tag', 'custom')
+        self.assertTrue(tainted(n, 'custom'))
+        self.assertFalse(tainted(n, XSS))
+
+
+class TestLayout(unittest.TestCase):
+
+    def test_no_instance_dict(self):
+        for v in ('no dict', u'no dict', 42, 4.2):
+            t = taint(v)
+            self.assertFalse(hasattr(t, '__dict__'))
+            self.assertRaises(AttributeError, setattr, t, 'attr', 1)
+
+    def test_label_in_class(self):
+        a = taint('label in class a', XSS)
+        b = taint('label in class b', XSS)
+        self.assertTrue(type(a) is type(b))
+        self.assertTrue(isinstance(a, STR))
+        b.taints.add(SQLI)
+        self.assertFalse(type(a) is type(b))
+        self.assertEqual(set([XSS]), a.taints)
+
+    def test_class_with_dict(self):
+        class Do(object):
+            def __init__(self, a, b):
+                self.a = a
+                self.b = b
+        TDo = taintmode.taint_class(Do)
+        m = taint('class with dict', XSS)
+        d = TDo(m, 2)
+        self.assertTrue(tainted(d, XSS))
+        d.a = 'clean'
+        self.assertFalse(tainted(d))
+        d.b = m
+        self.assertTrue(tainted(d, XSS))
+
+    def test_fields_sharing_tag(self):
+        class Box(object):
+            pass
+        TBox = taintmode.taint_class(Box)
+        b = TBox()
+        b.x = taint('field x', XSS)
+        b.y = taint('field y', XSS)
+        b.z = taint('field z', SQLI)
+        self.assertEqual(set([XSS, SQLI]), b.taints)
+        b.x = 'clean'
+        self.assertEqual(set([XSS, SQLI]), b.taints)
+        b.y = 'clean'
+        self.assertEqual(set([SQLI]), b.taints)
+        del b.z
+        self.assertFalse(tainted(b))
+
+
 class TestTainted(unittest.TestCase):
 
     def test_tainted(self):
@@ -775,6 +1078,26 @@ class TestSink(unittest.TestCase):
         self.assertTrue(saveDB2(n))
         self.assertTrue(saveDB3(n))
 
+    def test_kwargs(self):
+        n = some_input('test kwargs')
+        self.assertFalse(saveDB2(valor=n))
+        self.assertTrue(saveDB2(valor=cleanSQLI(n)))
+
+    def test_tag_registered_later(self):
+        @ssink(v='later', reached=reached)
+        def later_sink(valor):
+            return True
+        self.assertTrue(later_sink(taint('later a', XSS)))
+        self.assertFalse(later_sink(taint('later b', 'later')))
+
+    def test_checker_stops_early(self):
+        check = taintmode.sink_checker(SQLI)
+        class Boom(list):
+            def __iter__(self):
+                raise AssertionError('walked too far')
+        self.assertTrue(check([some_input('checker early'), Boom()]))
+        self.assertFalse(taintmode.sink_checker()(['a', ('b', 1)]))
+
 class TaintFunction(unittest.TestCase):
 
     def test_taint_values(self):
@@ -889,6 +1212,105 @@ class UnstrustedDecorator(unittest.TestCase):
         self.assertTrue(tainted(u[1][1][1]))
         self.assertTrue(isinstance(u[1][0][1], STR))
 
+class LazyUntrusted(unittest.TestCase):
+
+    def lazy_source(self, value):
+        return untrusted(lambda: value, lazy=True)()
+
+    def test_dict_on_access(self):
+        d = self.lazy_source({'a': 'lazy a', 'b': 'lazy b'})
+        self.assertFalse(tainted(dict.__getitem__(d, 'a')))
+        self.assertTrue(tainted(d['a']))
+        self.assertTrue(isinstance(d['a'], STR))
+        self.assertTrue(d['a'] is d['a'])
+        self.assertFalse(tainted(dict.__getitem__(d, 'b')))
+        self.assertTrue(tainted(d.get('b')))
+
+    def test_subclass_kept(self):
+        class Storage(dict):
+            def __getattr__(self, k):
+                return self[k]
+        d = self.lazy_source(Storage(name='lazy name'))
+        self.assertTrue(isinstance(d, Storage))
+        self.assertTrue(tainted(d.name))
+
+    def test_nested(self):
+        l = self.lazy_source([{'a': ('lazy nested', 1)}])
+        self.assertTrue(tainted(l[0]['a'][0]))
+        self.assertTrue(tainted(l[0]['a'][1]))
+        self.assertTrue(tainted(l[-1]['a'][-1]))
+        for x in l[0]['a']:
+            self.assertTrue(tainted(x))
+
+    def test_cleaner_sticks(self):
+        l = self.lazy_source(['lazy clean'])
+        @validator(SQLI, nargs=[0])
+        def valid(s):
+            return True
+        valid(l[0])
+        self.assertFalse(tainted(l[0], SQLI))
+        self.assertTrue(tainted(l[0], XSS))
+
+    def test_program_values(self):
+        l = self.lazy_source(['lazy program'])
+        l.append('trusted')
+        d = self.lazy_source({})
+        d['k'] = 'trusted'
+        self.assertTrue(tainted(l[0]))
+        self.assertFalse(tainted(l[1]))
+        self.assertFalse(tainted(d['k']))
+
+    def test_sink(self):
+        d = self.lazy_source({'a': [1, 'lazy sink']})
+        self.assertFalse(saveDB2(d))
+        self.assertTrue(saveDB2(self.lazy_source({'a': [None]})))
+
+    def test_cycle(self):
+        a = ['lazy cycle']
+        a.append(a)
+        l = self.lazy_source(a)
+        self.assertTrue(l[1] is l)
+        self.assertFalse(saveDB1(l))
+
+    def test_stored_same_object(self):
+        # interned strings and small ints are the same objects
+        d = self.lazy_source({'a': 'x', 'b': 1})
+        d['z'] = 'x'
+        d['w'] = 1
+        self.assertTrue(tainted(d['a']))
+        self.assertTrue(tainted(d['b']))
+        self.assertFalse(tainted(d['z']))
+        l = self.lazy_source([5, 'a'])
+        l.append(5)
+        self.assertTrue(tainted(l[0]))
+        self.assertFalse(tainted(l[2]))
+
+    def test_moved(self):
+        l = self.lazy_source([1, 2])
+        l.insert(0, 0)
+        self.assertEqual([tainted(x) for x in l], [False, True, True])
+        l.pop()
+        l.append(3)
+        self.assertEqual([tainted(x) for x in l], [False, True, False])
+
+    def test_shortcuts(self):
+        l = self.lazy_source([1])
+        self.assertTrue(tainted((l + [2])[0]))
+        self.assertTrue(tainted((l * 2)[1]))
+        self.assertTrue(tainted((self.lazy_source((1,)) + (2,))[0]))
+        d = self.lazy_source({'a': 'x'})
+        self.assertTrue(tainted(list(d.viewvalues())[0]))
+
+    def test_module_default(self):
+        taintmode.LAZY = True
+        try:
+            d = some_input({'a': 'lazy default'})
+        finally:
+            taintmode.LAZY = False
+        self.assertTrue(isinstance(d, taintmode.LazyDict))
+        self.assertTrue(tainted(d['a']))
+
+
 class CleanerDecorator(unittest.TestCase):
 
     def test_clener1(self):
@@ -909,6 +1331,613 @@ class ValidatorDecorator(unittest.TestCase):
         self.assertFalse(XSS in i.taints)
         self.assertTrue(SQLI in i.taints)
 
+class TestBuffers(unittest.TestCase):
+
+    def test_bytearray(self):
+        b = taint(bytearray('GET /'), XSS)
+        self.assertEqual(b, bytearray('GET /'))
+        self.assertTrue(tainted(b[:3], XSS))
+        self.assertTrue(all(tainted(x, XSS) for x in b))
+        self.assertTrue(tainted(b.upper(), XSS))
+
+    def test_bytearray_mutation(self):
+        b = taintmode.tclass(bytearray('GET '))
+        self.assertFalse(tainted(b))
+        b.extend(taint('/index', SQLI))
+        self.assertEqual(b, bytearray('GET /index'))
+        self.assertTrue(tainted(b, SQLI))
+
+    def test_memoryview_slice(self):
+        b = taint(bytearray('GET /index'), XSS)
+        v = MEMORYVIEW(b)[4:]
+        self.assertTrue(tainted(v, XSS))
+        self.assertEqual(v.tobytes(), '/index')
+        self.assertTrue(tainted(v.tobytes(), XSS))
+        b[4] = '_'
+        self.assertEqual(v.tobytes(), '_index')
+
+    def test_memoryview_setitem(self):
+        v = MEMORYVIEW(bytearray('abcd'))
+        self.assertFalse(tainted(v))
+        v[0:2] = taint('zz', SQLI)
+        self.assertEqual(v.tobytes(), 'zzcd')
+        self.assertTrue(tainted(v[2:], SQLI))
+
+    def test_dispatch(self):
+        v = taintmode.tclass(memoryview('abc'))
+        self.assertTrue(isinstance(v, MEMORYVIEW))
+        self.assertFalse(tainted(v))
+
+
+class TestPositional(unittest.TestCase):
+
+    def setUp(self):
+        positional_taint()
+
+    def tearDown(self):
+        positional_taint(False)
+
+    def test_concat(self):
+        q = "name='" + taint('bob', SQLI) + "' and " + taint('<x>', XSS)
+        self.assertTrue(isinstance(q, PSTR))
+        self.assertEqual(taint_ranges(q),
+                         [(6, 9, set([SQLI])), (15, 18, set([XSS]))])
+        self.assertEqual(q.taints, set([SQLI, XSS]))
+
+    def test_slicing(self):
+        q = 'abc' + taint('def', SQLI) + 'ghi'
+        self.assertEqual(taint_ranges(q[4:]), [(0, 2, set([SQLI]))])
+        self.assertEqual(taint_ranges(q[::2]), [(2, 3, set([SQLI]))])
+        self.assertEqual(taint_ranges(q[0]), [])
+        self.assertFalse(tainted(q[-1]))
+        self.assertTrue(tainted(q[3], SQLI))
+
+    def test_join(self):
+        sep = taint(', ', XSS)
+        r = sep.join(['a', taint('bob', SQLI)])
+        self.assertEqual(taint_ranges(r),
+                         [(1, 3, set([XSS])), (3, 6, set([SQLI]))])
+
+    def test_mod(self):
+        fmt = taint('%s=%5s|%-4s.', II)
+        r = fmt % ('a', taint('bob', SQLI), taint('b', XSS))
+        self.assertEqual(r, 'a=  bob|b   .')
+        self.assertEqual(taint_ranges(r),
+                         [(1, 2, set([II])), (4, 7, set([SQLI])),
+                          (7, 8, set([II])), (8, 9, set([XSS])),
+                          (12, 13, set([II]))])
+
+    def test_mod_mapping(self):
+        r = taint('%(a)s %(b)d', II) % {'a': taint('x', XSS), 'b': 1}
+        self.assertEqual(taint_ranges(r),
+                         [(0, 1, set([XSS])), (1, 2, set([II]))])
+
+    def test_mod_precision(self):
+        a = taint('abc', SQLI)
+        self.assertEqual(taint_ranges('%5.2s|' % a), [(3, 5, set([SQLI]))])
+        self.assertEqual(taint_ranges('%-5.2s|' % a), [(0, 2, set([SQLI]))])
+
+    def test_replace(self):
+        q = taint('a-b-c', XSS).replace('-', taint('+', SQLI), 1)
+        self.assertEqual(q, 'a+b-c')
+        self.assertEqual(taint_ranges(q),
+                         [(0, 1, set([XSS])), (1, 2, set([SQLI])),
+                          (2, 5, set([XSS]))])
+
+    def test_split_sep_in_piece(self):
+        parts = ('aXaX' + taint('a', SQLI)).split('XaX')
+        self.assertEqual([taint_ranges(p) for p in parts],
+                         [[], [(0, 1, set([SQLI]))]])
+
+    def test_split(self):
+        q = "id='" + taint('bob', SQLI) + "'"
+        parts = q.split("'")
+        self.assertEqual(parts, ['id=', 'bob', ''])
+        self.assertEqual([tainted(p) for p in parts], [False, True, False])
+
+    def test_whole_methods(self):
+        q = 'abc' + taint('def', SQLI)
+        self.assertEqual(taint_ranges(q.upper()), [(0, 6, set([SQLI]))])
+
+    def test_taints_change(self):
+        q = 'abc' + taint('def', SQLI)
+        q.taints.add(XSS)
+        self.assertEqual(taint_ranges(q),
+                         [(0, 3, set([XSS])), (3, 6, set([SQLI, XSS]))])
+        q.taints.discard(SQLI)
+        self.assertEqual(taint_ranges(q), [(0, 6, set([XSS]))])
+
+    def test_unicode(self):
+        q = u'ab' + taint(u'\xe9t\xe9', XSS) + 'c'
+        self.assertTrue(isinstance(q, PUNICODE))
+        self.assertEqual(taint_ranges(q), [(2, 5, set([XSS]))])
+
+    def test_off(self):
+        positional_taint(False)
+        q = 'abc' + taint('def', SQLI)
+        self.assertFalse(isinstance(q, PSTR))
+        self.assertEqual(taint_ranges(q), [(0, 6, set([SQLI]))])
+
+
+class TestFormatting(unittest.TestCase):
+
+    def test_mod_mapping_used_keys(self):
+        f = STR('%(a)s %(b)d')
+        r = f % {'a': taint('x', XSS), 'b': 1, 'c': taint('y', SQLI)}
+        self.assertEqual(r, 'x 1')
+        self.assertEqual(r.taints, set([XSS]))
+
+    def test_mod_tuple(self):
+        r = STR('%s %s') % (taint('x', XSS), [taint('y', SQLI)])
+        self.assertEqual(r.taints, set([XSS, SQLI]))
+
+    def test_rmod(self):
+        r = '%s!' % taint('x', OSI)
+        self.assertEqual(r, 'x!')
+        self.assertEqual(r.taints, set([OSI]))
+
+    def test_format_used_fields(self):
+        r = STR('{0} {b[k]}').format(taint('x', XSS), taint('z', II),
+                                     b={'k': taint('y', SQLI),
+                                        'j': taint('w', OSI)})
+        self.assertEqual(r, 'x y')
+        self.assertEqual(r.taints, set([XSS, SQLI]))
+
+    def test_format_auto_nested(self):
+        r = STR('{} {:{}}').format('a', 'b', taint(3, II))
+        self.assertEqual(r, 'a b  ')
+        self.assertEqual(r.taints, set([II]))
+
+    def test_format_attribute(self):
+        r = STR('{0.real}').format(taint(2, OSI))
+        self.assertEqual(r.taints, set([OSI]))
+
+    def test_format_map(self):
+        from collections import defaultdict
+        d = defaultdict(lambda: taint('?', XSS), a='1')
+        r = STR('{a}{b}').format_map(d)
+        self.assertEqual(r, '1?')
+        self.assertEqual(r.taints, set([XSS]))
+
+    def test_tainted_format(self):
+        r = taint(u'{0}', SQLI).format('a')
+        self.assertTrue(isinstance(r, unicode))
+        self.assertEqual(r.taints, set([SQLI]))
+
+
+class TestStringBuilder(unittest.TestCase):
+
+    def test_getvalue(self):
+        b = StringBuilder('ls ')
+        b.write(taint('-l', OSI))
+        b.writelines([' ', taint('/tmp', XSS), 1])
+        v = b.getvalue()
+        self.assertEqual(v, 'ls -l /tmp1')
+        self.assertEqual(v.taints, set([OSI, XSS]))
+        self.assertEqual(b.tell(), 11)
+
+    def test_untainted(self):
+        b = StringBuilder()
+        b.write('a')
+        self.assertFalse(tainted(b.getvalue()))
+
+    def test_non_string(self):
+        b = StringBuilder()
+        b.write('id=')
+        b.write(taint(5, SQLI))
+        v = b.getvalue()
+        self.assertEqual(v, 'id=5')
+        self.assertTrue(tainted(v, SQLI))
+
+    def test_unicode(self):
+        b = StringBuilder()
+        b.write('a')
+        b.write(taint(u'\xe9', XSS))
+        v = b.getvalue()
+        self.assertTrue(isinstance(v, unicode))
+        self.assertTrue(tainted(v, XSS))
+
+    def test_positional(self):
+        positional_taint()
+        try:
+            b = StringBuilder()
+            for s in ['a', taint('bc', SQLI), 'd', taint('e', SQLI)]:
+                b.write(s)
+            v = b.getvalue()
+        finally:
+            positional_taint(False)
+        self.assertEqual(taint_ranges(v),
+                         [(1, 3, set([SQLI])), (4, 5, set([SQLI]))])
+
+    def test_join_generator(self):
+        r = taint(',', XSS).join(x for x in ['a', taint('b', SQLI)])
+        self.assertEqual(r, 'a,b')
+        self.assertEqual(r.taints, set([XSS, SQLI]))
+
+
+class TestColumn(unittest.TestCase):
+
+    def test_taint_many(self):
+        c = taint_many(['a', 'b', 'c'], XSS)
+        self.assertEqual(list(tainted_mask(c, XSS)), [True, True, True])
+        self.assertEqual(list(tainted_mask(c, SQLI)), [False, False, False])
+        self.assertTrue(tainted(c[1], XSS))
+        self.assertEqual(c[1], 'b')
+
+    def test_keeps_labels(self):
+        c = taint_many(['a', taint('b', SQLI)], XSS)
+        self.assertEqual(list(tainted_mask(c, SQLI)), [False, True])
+        self.assertEqual(c.taints, set([XSS, SQLI]))
+
+    def test_clean_many(self):
+        c = clean_many(taint_many(['a', 'b'], XSS), XSS, str.upper)
+        self.assertEqual(list(tainted_mask(c)), [False, False])
+        self.assertEqual(list(c), ['A', 'B'])
+        self.assertFalse(tainted(c))
+
+    def test_slice(self):
+        c = Column(['a', taint('b', SQLI), 'c'])
+        self.assertEqual(list(tainted_mask(c[1:])), [True, False])
+        self.assertFalse(tainted(c[::2]))
+
+    def test_element_copy(self):
+        s = taint('b', SQLI)
+        c = clean_many([s], SQLI)
+        self.assertFalse(tainted(c[0]))
+        self.assertTrue(tainted(s, SQLI))
+
+    def test_sink_and_cleaner(self):
+        c = taint_many(['1', '2'], SQLI)
+        self.assertFalse(saveDB2(c))
+        self.assertTrue(saveDB2(cleaner(SQLI)(lambda c: c)(c)))
+        self.assertTrue(saveDB3(c))
+
+    def test_untrusted(self):
+        c = untrusted(lambda: Column(['a', 'b']))()
+        self.assertEqual(list(tainted_mask(c, OSI)), [True, True])
+
+    def test_plain_values(self):
+        self.assertEqual(tainted_mask(['a', taint('b')]), [False, True])
+
+    def test_elementwise(self):
+        c = Column([1, 2, 3], None) + taint_many([10, 20, 30], OSI)
+        self.assertEqual(c.values, [11, 22, 33])
+        self.assertEqual(list(tainted_mask(c, OSI)), [True, True, True])
+        d = 2 * c[:2]
+        self.assertEqual(d.values, [22, 44])
+        self.assertTrue(tainted(d, OSI))
+        self.assertEqual((-d).values, [-22, -44])
+
+    def test_elementwise_scalar_label(self):
+        c = Column([1, 2]) * taint(3, II)
+        self.assertEqual(list(tainted_mask(c, II)), [True, True])
+
+    def test_compare(self):
+        c = taint_many([1, 5], XSS) > 2
+        self.assertEqual(c.values, [False, True])
+        self.assertTrue(tainted(c, XSS))
+
+    def test_concatenate(self):
+        c = concatenate([Column(['a']), taint_many(['b'], SQLI), ['c']])
+        self.assertEqual(list(c), ['a', 'b', 'c'])
+        self.assertEqual(list(tainted_mask(c)), [False, True, False])
+
+    @unittest.skipIf(taintmode.numpy is None, 'numpy is not installed')
+    def test_numpy(self):
+        import numpy
+        c = untrusted(lambda: numpy.arange(4))()
+        self.assertTrue(isinstance(c, Column))
+        d = c[2:] * 2
+        self.assertEqual(list(d.values), [4, 6])
+        self.assertEqual(list(tainted_mask(d, SQLI)), [True, True])
+        self.assertFalse(tainted(clean_many(d, SQLI), SQLI))
+
+    @unittest.skipIf(taintmode.numpy is None, 'numpy is not installed')
+    def test_numpy_rows(self):
+        import numpy
+        values = numpy.arange(6).reshape(3, 2)
+        for c in [Column(values), untrusted(lambda: values)()]:
+            self.assertEqual(len(c.masks), 3)
+            self.assertEqual(list(c[1]), [2, 3])
+
+
+
+class TestTrusted(unittest.TestCase):
+
+    def test_sink(self):
+        self.assertEqual(saveDB2.trusted(taint('x')), True)
+
+    def test_cleaner(self):
+        self.assertEqual(cleanSQLI.trusted('a--'), 'a')
+
+    def test_propagated(self):
+        r = taintmode.len.trusted(taint('abc'))
+        self.assertEqual(r, 3)
+        self.assertFalse(tainted(r))
+
+
+class Collect(object):
+    '''A reporter keeping the violations.'''
+
+    def __init__(self):
+        self.violations = []
+
+    def report(self, violation):
+        self.violations.append(violation)
+
+    def flush(self):
+        pass
+
+
+@ssink(v=SQLI)
+def query(q):
+    return True
+
+
+class TestViolations(unittest.TestCase):
+
+    def setUp(self):
+        self.reporter = taintmode.reporter
+        taintmode.reporter = Collect()
+
+    def tearDown(self):
+        taintmode.reporter = self.reporter
+
+    def test_event(self):
+        line = sys._getframe().f_lineno + 1
+        query(some_input('x' * 300))
+        v, = taintmode.reporter.violations
+        self.assertEqual(v.code, sys._getframe().f_code)
+        self.assertEqual(v.lineno, line)
+        self.assertEqual((v.tag, v.sink), (SQLI, 'query'))
+        self.assertEqual(v.value, 'x' * taintmode.MAX_VALUE_LEN + '...')
+        self.assertTrue(v.context()[3].startswith('-->'))
+        self.assertTrue('query(some_input' in v.context()[3])
+
+    def test_value_not_truncated(self):
+        n = taintmode.MAX_VALUE_LEN
+        query(some_input(u'x' * n))
+        v, = taintmode.reporter.violations
+        self.assertEqual(v.value, u'x' * n)
+
+    def test_stream(self):
+        out = StringIO.StringIO()
+        taintmode.reporter = StreamReporter(out, buffer_size=2)
+        query(some_input('a'))
+        self.assertEqual(out.getvalue(), '')
+        query(some_input('b'))
+        lines = out.getvalue().splitlines()
+        self.assertEqual([l for l in lines if l.startswith('Tainted value')],
+                         ['Tainted value: a', 'Tainted value: b'])
+
+
+class TestQueueReporter(unittest.TestCase):
+
+    def setUp(self):
+        self.reporter = taintmode.reporter
+        self.out = StringIO.StringIO()
+        taintmode.reporter = QueueReporter(json_lines(self.out), interval=60,
+                                           rate=2)
+
+    def tearDown(self):
+        taintmode.reporter.close()
+        taintmode.reporter = self.reporter
+
+    def records(self):
+        return [json.loads(l) for l in self.out.getvalue().splitlines()]
+
+    def test_aggregated(self):
+        for i in range(5):
+            query(some_input('x'))
+        self.assertEqual(self.out.getvalue(), '')
+        taintmode.reporter.flush()
+        r, = self.records()
+        self.assertEqual((r['count'], r['sink'], r['tag'], r['value']),
+                         (5, 'query', SQLI, 'x'))
+
+    def test_rate(self):
+        query(some_input('a'))
+        query(some_input('b'))
+        query(some_input('c'))
+        taintmode.reporter.close()
+        self.assertEqual([r['value'] for r in self.records()], ['a', 'b'])
+        self.assertEqual(taintmode.reporter.dropped, 1)
+
+
+class TestSampler(unittest.TestCase):
+
+    def setUp(self):
+        self.reached = []
+        self.executed = []
+
+        @ssink(v=SQLI, reached=self.reached.append)
+        def sink(q):
+            self.executed.append(q)
+        self.sink = sink
+        taintmode.SAMPLER = Sampler(first=2, every=3, period=None)
+
+    def tearDown(self):
+        taintmode.SAMPLER = None
+
+    def test_sampling(self):
+        for i in range(10):
+            self.sink(some_input(str(i)))
+        self.assertEqual(self.reached, ['0', '1', '4', '7'])
+        self.assertEqual(self.executed, [])
+
+    def test_sites(self):
+        for i in range(3):
+            self.sink(some_input('a'))
+            self.sink(some_input('b'))
+        self.assertEqual(self.reached, ['a', 'b', 'a', 'b'])
+
+    def test_raises(self):
+        taintmode.RAISES = True
+        try:
+            for i in range(4):
+                self.assertRaises(taintmode.TaintException, self.sink,
+                                  some_input('x'))
+        finally:
+            taintmode.RAISES = False
+        self.assertEqual(self.reached, ['x', 'x'])
+
+    def test_summary(self):
+        collect = Collect()
+        default, taintmode.reporter = taintmode.reporter, collect
+        try:
+            for i in range(4):
+                self.sink(some_input('x'))
+            taintmode.SAMPLER.summarize()
+        finally:
+            taintmode.reporter = default
+        s, = collect.violations
+        self.assertEqual(s.count, 2)
+        self.assertEqual(s.code, sys._getframe().f_code)
+        self.assertEqual(s.sink, 'sink')
+        self.assertTrue(str(s).startswith('2 violations not reported'))
+        self.assertEqual(s.record()['count'], 2)
+
+    def test_summary_queued(self):
+        records = []
+        q = QueueReporter(records.extend, interval=60)
+        try:
+            code = sys._getframe().f_code
+            q.report(Skipped(code, 1, 'sink', 2))
+            q.report(Skipped(code, 1, 'sink', 3))
+        finally:
+            q.close()
+        self.assertEqual([(r['count'], r['skipped']) for r in records],
+                         [(5, True)])
+
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        profiling()
+
+        @untrusted
+        def source():
+            return ['abc', 'de']
+
+        @ssink(v=SQLI, reached=reached)
+        def sink(q):
+            return True
+        self.source, self.sink = source, sink
+        taintmode.reset_stats()
+
+    def tearDown(self):
+        profiling(False)
+
+    def test_counters(self):
+        self.sink('plain')
+        self.sink(self.source())
+        stats = stats_snapshot()
+        source = stats[__name__ + '.source']
+        sink = stats[__name__ + '.sink']
+        self.assertEqual((source['kind'], source['calls'], source['bytes']),
+                         ('untrusted', 1, 5))
+        self.assertTrue(source['mapt_time'] > 0)
+        self.assertEqual((sink['calls'], sink['tainted']), (2, 1))
+        self.assertTrue(sink['collect_tags_time'] > 0)
+
+    def test_stacked(self):
+        @cleaner(XSS)
+        @cleaner(SQLI)
+        def esc(s):
+            return s
+
+        @ssink(XSS, reached=reached)
+        @ssink(SQLI, reached=reached)
+        def render(s):
+            return s
+        self.assertEqual(esc.__name__, 'esc')
+        render(esc(self.source()[0]))
+        stats = stats_snapshot()
+        self.assertFalse('taintmode.profile' in stats)
+        self.assertEqual((stats[__name__ + '.esc']['kind'],
+                          stats[__name__ + '.esc']['calls']), ('cleaner', 1))
+        self.assertEqual((stats[__name__ + '.render']['kind'],
+                          stats[__name__ + '.render']['calls']), ('ssink', 1))
+
+    def test_off(self):
+        profiling(False)
+
+        @cleaner(SQLI)
+        def clean(s):
+            return s
+        self.assertEqual(clean.trusted.__name__, 'clean')
+        self.assertFalse(__name__ + '.clean' in stats_snapshot())
+        self.assertTrue(taintmode.mapt is taintmode._plain['mapt'])
+
+    def test_dump(self):
+        self.source()
+        out = StringIO.StringIO()
+        dump_stats(out)
+        stats = json.loads(out.getvalue())
+        self.assertEqual(stats[__name__ + '.source']['calls'], 1)
+
+
+class TestSwitch(unittest.TestCase):
+
+    def setUp(self):
+        taint_tracking(False)
+
+    def tearDown(self):
+        taint_tracking(True)
+
+    def test_decorators(self):
+        def f(x):
+            return x
+        self.assertTrue(untrusted(f) is f)
+        self.assertTrue(untrusted_args([0])(f) is f)
+        self.assertTrue(ssink(SQLI)(f) is f)
+        self.assertTrue(cleaner(SQLI)(f) is f)
+        self.assertTrue(validator(SQLI)(f) is f)
+        self.assertTrue(taintmode.propagate_func(f) is f)
+
+    def test_taint(self):
+        o = object()
+        self.assertTrue(taint(o) is o)
+        self.assertFalse(tainted(taint('x')))
+
+    def test_environment(self):
+        def flags(value):
+            env = dict(os.environ, TAINTMODE_OFF=value,
+                       TAINTMODE_PROFILE=value)
+            out = subprocess.check_output(
+                [sys.executable, '-c', 'import taintmode as t; '
+                                       'print t.ENABLED, t.PROFILE'],
+                env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+            return out.split()
+        self.assertEqual(flags(''), ['True', 'False'])
+        self.assertEqual(flags('0'), ['True', 'False'])
+        self.assertEqual(flags('1'), ['False', 'True'])
+
+    def test_rewritten_calls(self):
+        # calls rewritten by wrapstrings/cleanpaths.py still work
+        sys.path.insert(0, os.path.join(os.path.dirname(__file__),
+                                        'wrapstrings'))
+        try:
+            from gen import ast
+            import cleanpaths
+        finally:
+            del sys.path[0]
+        tree = ast.parse('from taintmode import *\n'
+                         '@ssink(SQLI)\n'
+                         'def query(q):\n'
+                         '    return q\n'
+                         'r = query("a"), len("abc")\n')
+        cleanpaths.rewrite([tree])
+        env = {}
+        exec compile(tree, '<rewritten>', 'exec') in env
+        self.assertEqual(env['r'], ('a', 3))
+        self.assertFalse(hasattr(env['query'], 'trusted'))
+
+    def test_earlier(self):
+        # decorated while tracking was on
+        self.assertTrue(tainted(some_input('x')))
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,545 @@
+'''
+Static pre-pass for programs using taintmode.py
+
+This module parses the files of a program looking for the values that may
+come from untrusted sources (functions decorated with untrusted or
+untrusted_args, values wrapped with untrusted and calls to taint), and for
+everything they can flow into. Calls to sinks, cleaners, validators and to
+taintmode's len, ord and chr whose arguments can never be one of those
+values are rewritten to call the undecorated function, which skips the
+label collection:
+
+    save(query)         -->     getattr(save, 'trusted', save)(query)
+
+Use:
+
+    python cleanpaths.py file.py [other files of the program]
+
+The rewritten first file is printed, preceded by a report of the clean
+functions found. The analysis is flow insensitive and goes by name: a
+variable is dirty if any assignment to it is, a function if any of its
+return values is, and every function with a given name gets the
+arguments of every call using that name. Attributes are tracked by name
+only, across all objects, and module globals are also attributes. It assumes the given files are the whole
+program; if any of them uses exec, eval, setattr or the like, nothing is
+considered clean.
+'''
+from gen import ast, codegen
+
+SOURCES = set(['untrusted', 'untrusted_args', 'taint'])
+CHECKED = set(['ssink', 'cleaner', 'validator'])
+CLEANING = set(['cleaner', 'validator'])
+PROPAGATED = set(['len', 'ord', 'chr'])
+OPAQUE = set(['eval', 'execfile', 'setattr', 'globals', 'locals', 'vars',
+              '__import__', 'input'])
+
+
+def callee_name(node):
+    '''Return the name called by the call target node: f for f or a.b.f.'''
+    if isinstance(node, ast.Name):
+        return node.id
+    if isinstance(node, ast.Attribute):
+        return node.attr
+    return None
+
+
+def dotted_name(node):
+    '''Return 'a.b.c' for the expression a.b.c, or None.'''
+    names = []
+    while isinstance(node, ast.Attribute):
+        names.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    names.append(node.id)
+    return '.'.join(reversed(names))
+
+
+def call_arguments(node):
+    '''Return the expressions passed as arguments by the call node.'''
+    args = list(node.args) + [k.value for k in node.keywords]
+    args.extend(a for a in (node.starargs, node.kwargs) if a is not None)
+    return args
+
+
+def decorator_name(node):
+    if isinstance(node, ast.Call):
+        node = node.func
+    return callee_name(node)
+
+
+class Scope(object):
+    '''A function, lambda or class body.'''
+
+    def __init__(self, name, node, parent, is_class=False):
+        self.name = name
+        self.node = node
+        self.parent = parent
+        self.is_class = is_class
+        if parent is None:
+            self.qual = name
+        else:
+            self.qual = '%s.%s' % (parent.qual, name)
+        self.locals = set()
+        self.globals = set()
+        self.params = []
+        self.returns = []   # symbols holding what the function returns
+
+
+class Analysis(object):
+    '''
+    Dirty symbols of a program, given as a list of parsed modules.
+
+    Symbols are plain names for globals, 'function.qualname:name' for local
+    variables and parameters and '.name' for attributes.
+    '''
+
+    def __init__(self, trees):
+        self.trees = trees
+        self.dirty = set()
+        self.mutated = set()
+        self.aliases = {}
+        self.defs = {}          # function name -> scopes
+        self.classes = {}       # class name -> scope
+        self.scopes = {}        # id(node) -> scope of its body
+        self.callees = set()    # ids of the nodes called
+        self.callbacks = set()  # ids of the nodes passed to a call
+        self.bindings = []      # (kind, name, scope) of the names bound
+        self.checked_attrs = set()
+        self.propagated = set()
+        self.opaque = False
+        self.dirty_raise = False
+        self.wrapped = set()    # ids of the targets of f = ssink(v)(f)
+        self.cleaner_bindings = []  # (name, scope, function cleaning)
+        self.cleaning = {}      # checked symbol -> names of functions
+        for t in trees:
+            self.collect(t, None)
+        self.resolve_checked()
+        changed = True
+        while changed:
+            before = self.dirty.__len__()
+            for t in trees:
+                for n, scope in self.walk(t, None):
+                    self.flow(n, scope)
+            self.propagate_mutations()
+            changed = self.dirty.__len__() != before
+
+    # -------------------------------------------------------------- symbols
+
+    def symbol(self, name, scope):
+        s = scope
+        while s is not None:
+            if name in s.locals and name not in s.globals:
+                if s.is_class:
+                    return '.' + name
+                return '%s:%s' % (s.qual, name)
+            s = s.parent
+            while s is not None and s.is_class:
+                s = s.parent    # class bodies aren't enclosing scopes
+        return name
+
+    def mark(self, sym):
+        self.dirty.add(sym)
+        if ':' not in sym:
+            # module globals are also read and set as module attributes
+            self.dirty.add(sym[1:] if sym.startswith('.') else '.' + sym)
+
+    def mutate(self, node, scope, args=()):
+        '''
+        The object node evaluates to gets a dirty value stored in it, by a
+        call with args if any.
+        '''
+        while isinstance(node, (ast.Attribute, ast.Subscript)):
+            if isinstance(node, ast.Attribute):
+                self.mark('.' + node.attr)
+            node = node.value
+        if isinstance(node, ast.Name):
+            sym = self.symbol(node.id, scope)
+            self.mark(sym)
+            self.mutated.add(sym)
+        elif node is not None:
+            # d.setdefault(k, []).append(x), ...: the object may come from
+            # anything the expression or the call reads
+            for n in [x for e in [node] + list(args) for x in ast.walk(e)]:
+                if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Load):
+                    sym = self.symbol(n.id, scope)
+                    self.mark(sym)
+                    self.mutated.add(sym)
+                elif isinstance(n, ast.Attribute):
+                    self.mark('.' + n.attr)
+
+    def link(self, a, b):
+        self.aliases.setdefault(a, set()).add(b)
+        self.aliases.setdefault(b, set()).add(a)
+
+    def propagate_mutations(self):
+        '''Objects stored in a mutated variable may be shared by others.'''
+        stack = list(self.mutated)
+        seen = set(stack)
+        while stack:
+            sym = stack.pop()
+            self.mark(sym)
+            for other in self.aliases.get(sym, ()):
+                if other not in seen:
+                    seen.add(other)
+                    stack.append(other)
+        self.mutated = seen
+
+    # ------------------------------------------------------------ traversal
+
+    def walk(self, node, scope):
+        '''Yield every node under node with the scope it is evaluated in.'''
+        stack = [(node, scope)]
+        while stack:
+            n, s = stack.pop()
+            yield n, s
+            inner = self.scopes.get(id(n))
+            for child in ast.iter_child_nodes(n):
+                if inner is not None and self.in_body(n, child):
+                    stack.append((child, inner))
+                else:
+                    stack.append((child, s))
+
+    def in_body(self, node, child):
+        '''Tell if child is evaluated in the scope node creates.'''
+        if isinstance(node, ast.Lambda):
+            return child is node.body
+        return child in node.body
+
+    def collect(self, tree, scope):
+        '''Find scopes, local names, definitions and sources.'''
+        # walk resumes after the scope of a definition has been created
+        for n, s in self.walk(tree, scope):
+            if isinstance(n, ast.FunctionDef):
+                self.define(n, s)
+            elif isinstance(n, ast.Lambda):
+                self.define(n, s)
+            elif isinstance(n, ast.ClassDef):
+                self.bind_name(n.name, s)
+                self.scopes[id(n)] = cs = Scope(n.name, n, s, True)
+                self.classes[n.name] = cs
+            elif isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store):
+                self.bind_name(n.id, s)
+                if id(n) not in self.wrapped:
+                    self.bindings.append(('plain', n.id, s))
+            elif isinstance(n, ast.Global) and s is not None:
+                s.globals.update(n.names)
+            elif isinstance(n, (ast.Import, ast.ImportFrom)):
+                for a in n.names:
+                    if a.name != '*':
+                        self.bind_name((a.asname or a.name).split('.')[0], s)
+                if isinstance(n, ast.ImportFrom) and \
+                   n.module == 'taintmode':
+                    self.propagated.update(
+                        PROPAGATED if n.names[0].name == '*' else
+                        PROPAGATED & set(a.name for a in n.names
+                                         if a.asname is None))
+            elif isinstance(n, ast.Exec):
+                self.opaque = True
+            elif isinstance(n, ast.Call):
+                self.callees.add(id(n.func))
+                for a in n.args:
+                    self.callbacks.add(id(a))
+                for k in n.keywords:
+                    self.callbacks.add(id(k.value))
+                if callee_name(n.func) in OPAQUE:
+                    self.opaque = True
+            elif isinstance(n, ast.Assign):
+                self.collect_assign(n, s)
+
+    def define(self, node, scope):
+        if isinstance(node, ast.Lambda):
+            name = '<lambda%d>' % id(node)
+        else:
+            name = node.name
+            self.bind_name(name, scope)
+        fs = self.scopes[id(node)] = Scope(name, node, scope)
+        args = node.args
+        for a in args.args:
+            for n in ast.walk(a):
+                if isinstance(n, ast.Name):
+                    fs.params.append(n.id)
+        fs.params.extend(p for p in (args.vararg, args.kwarg) if p)
+        fs.locals.update(fs.params)
+        if isinstance(node, ast.Lambda):
+            return
+        self.defs.setdefault(name, []).append(fs)
+        fs.returns = [self.symbol_in(name, scope), '.' + name]
+        decorators = set(decorator_name(d) for d in node.decorator_list)
+        if decorators & SOURCES:
+            for sym in fs.returns:
+                self.mark(sym)
+        if 'untrusted_args' in decorators:
+            for p in fs.params:
+                self.mark('%s:%s' % (fs.qual, p))
+        if decorators & CHECKED and (scope is None or not scope.is_class):
+            # methods would get .trusted unbound, so they're left alone
+            self.bindings.append(('checked def', name, scope))
+            if decorators & CLEANING:
+                self.cleaner_bindings.append((name, scope, name))
+        else:
+            self.bindings.append(('plain def', name, scope))
+
+    def symbol_in(self, name, scope):
+        if scope is None:
+            return name
+        if scope.is_class:
+            return '.' + name
+        return '%s:%s' % (scope.qual, name)
+
+    def bind_name(self, name, scope):
+        if scope is not None:
+            scope.locals.add(name)
+
+    def collect_assign(self, node, scope):
+        # x = ssink(v)(f), db.delete = cleaner(v)(db.delete), ...
+        v = node.value
+        if isinstance(v, ast.Call) and isinstance(v.func, ast.Call) and \
+           callee_name(v.func.func) in CHECKED:
+            cleaning = callee_name(v.func.func) in CLEANING and v.args and \
+                       callee_name(v.args[0])
+            for t in node.targets:
+                if isinstance(t, ast.Name):
+                    self.wrapped.add(id(t))
+                    self.bindings.append(('checked', t.id, scope))
+                    if cleaning:
+                        self.cleaner_bindings.append((t.id, scope, cleaning))
+                elif dotted_name(t) is not None:
+                    self.checked_attrs.add(dotted_name(t))
+                    if cleaning:
+                        self.cleaning.setdefault(dotted_name(t),
+                                                 set()).add(cleaning)
+
+    def resolve_checked(self):
+        '''
+        Find the symbols of the checked functions that can be given a
+        .trusted call: those only ever bound to a sink, cleaner or
+        validator, or rebound to one, like f = ssink()(f).
+        '''
+        kinds = {}
+        for kind, name, scope in self.bindings:
+            kinds.setdefault(self.symbol(name, scope), set()).add(kind)
+        self.checked_syms = set()
+        for sym, k in kinds.iteritems():
+            if 'plain' in k:
+                continue
+            if 'checked' in k or k == set(['checked def']):
+                self.checked_syms.add(sym)
+        for name in self.propagated:
+            if name not in kinds:
+                self.checked_syms.add(name)
+        for name, scope, f in self.cleaner_bindings:
+            self.cleaning.setdefault(self.symbol(name, scope), set()).add(f)
+
+    # ----------------------------------------------------------------- flow
+
+    def is_dirty(self, node, scope):
+        '''Tell if the expression node may evaluate to a tainted value.'''
+        if self.opaque:
+            return True
+        for n, s in self.walk(node, scope):
+            if isinstance(n, ast.Name):
+                if isinstance(n.ctx, ast.Load) and \
+                   self.symbol(n.id, s) in self.dirty:
+                    return True
+            elif isinstance(n, ast.Attribute):
+                if '.' + n.attr in self.dirty:
+                    return True
+            elif isinstance(n, ast.Call):
+                if callee_name(n.func) in SOURCES:
+                    return True
+        return False
+
+    def bind(self, target, dirty, value, scope):
+        '''Assign value, dirty or not, to target.'''
+        if isinstance(target, ast.Name):
+            sym = self.symbol(target.id, scope)
+            if value is not None:
+                for n in ast.walk(value):
+                    if isinstance(n, ast.Name):
+                        self.link(sym, self.symbol(n.id, scope))
+            if dirty:
+                self.mark(sym)
+        elif isinstance(target, (ast.Tuple, ast.List)):
+            for e in target.elts:
+                self.bind(e, dirty, value, scope)
+        elif isinstance(target, ast.Attribute):
+            if dirty:
+                self.mark('.' + target.attr)
+                self.mutate(target.value, scope)
+        elif isinstance(target, ast.Subscript):
+            if dirty:
+                self.mutate(target.value, scope)
+
+    def flow(self, n, scope):
+        if isinstance(n, ast.Assign):
+            d = self.is_dirty(n.value, scope)
+            for t in n.targets:
+                self.bind(t, d, n.value, scope)
+        elif isinstance(n, ast.AugAssign):
+            self.bind(n.target, self.is_dirty(n.value, scope), n.value, scope)
+        elif isinstance(n, (ast.For, ast.comprehension)):
+            self.bind(n.target, self.is_dirty(n.iter, scope), n.iter, scope)
+        elif isinstance(n, ast.With):
+            if n.optional_vars is not None:
+                self.bind(n.optional_vars,
+                          self.is_dirty(n.context_expr, scope),
+                          n.context_expr, scope)
+        elif isinstance(n, (ast.Return, ast.Yield)):
+            if n.value is not None and self.is_dirty(n.value, scope):
+                if scope is not None:
+                    for sym in scope.returns:
+                        self.mark(sym)
+        elif isinstance(n, ast.Lambda):
+            if id(n) not in self.callbacks:
+                # stored or returned, it may be called with anything
+                self.dirty_params(self.scopes[id(n)])
+        elif isinstance(n, ast.Raise):
+            if any(self.is_dirty(c, scope) for c in ast.iter_child_nodes(n)):
+                self.dirty_raise = True
+        elif isinstance(n, ast.ExceptHandler):
+            if n.name is not None and self.dirty_raise:
+                self.bind(n.name, True, None, scope)
+        elif isinstance(n, ast.Call):
+            self.flow_call(n, scope)
+        elif isinstance(n, (ast.Name, ast.Attribute)):
+            name = callee_name(n)
+            if name in self.defs and id(n) not in self.callees and \
+               id(n) not in self.callbacks and \
+               isinstance(n.ctx, ast.Load):
+                # a function used as a value may be called with anything
+                for fs in self.defs[name]:
+                    self.dirty_params(fs)
+
+    def dirty_params(self, fs):
+        for p in fs.params:
+            self.mark('%s:%s' % (fs.qual, p))
+
+    def flow_call(self, n, scope):
+        args = call_arguments(n)
+        dirty = any(self.is_dirty(a, scope) for a in args)
+        name = callee_name(n.func)
+        targets = list(self.defs.get(name, ()))
+        if name in self.classes:
+            for m in ('__init__', '__new__'):
+                targets.extend(fs for fs in self.defs.get(m, ())
+                               if fs.parent is self.classes[name])
+        for fs in targets:
+            for a in args:
+                if isinstance(a, ast.Name):
+                    for p in fs.params:
+                        self.link(self.symbol(a.id, scope),
+                                  '%s:%s' % (fs.qual, p))
+            if dirty:
+                self.dirty_params(fs)
+        if dirty:
+            if isinstance(n.func, ast.Attribute):
+                # l.append(x), d.update(x), ...
+                self.mutate(n.func.value, scope, args)
+            for a in args:
+                # functions and lambdas passed along get the other arguments
+                if isinstance(a, ast.Lambda):
+                    self.dirty_params(self.scopes[id(a)])
+                elif callee_name(a) in self.defs:
+                    for fs in self.defs[callee_name(a)]:
+                        self.dirty_params(fs)
+
+    # -------------------------------------------------------------- results
+
+    def clean_functions(self):
+        '''Return the qualified names of the functions never seeing taint.'''
+        clean = []
+        for fss in self.defs.itervalues():
+            for fs in fss:
+                if any(self.is_dirty(n, fs) for n in fs.node.body):
+                    continue
+                if any('%s:%s' % (fs.qual, p) in self.dirty
+                       for p in fs.params):
+                    continue
+                if not any(sym in self.dirty for sym in fs.returns):
+                    clean.append(fs.qual)
+        return sorted(clean)
+
+    def clean_module(self, tree):
+        '''Tell if nothing in the parsed module tree may be tainted.'''
+        return not self.is_dirty(tree, None)
+
+    def trusted_calls(self, tree):
+        '''Return the ids of the checked calls in tree with clean arguments.'''
+        calls = set()
+        for n, s in self.walk(tree, None):
+            if not isinstance(n, ast.Call):
+                continue
+            f = n.func
+            if isinstance(f, ast.Name):
+                key = self.symbol(f.id, s)
+                checked = key in self.checked_syms
+            else:
+                key = dotted_name(f)
+                checked = key in self.checked_attrs
+            if checked and not self.dirty_result(key) and \
+               not any(self.is_dirty(a, s) for a in call_arguments(n)):
+                calls.add(id(n))
+        return calls
+
+    def dirty_result(self, key):
+        '''
+        Tell if the cleaner or validator key may return a tainted value of
+        its own making, which only the decorated call cleans.
+        '''
+        for name in self.cleaning.get(key, ()):
+            for fs in self.defs.get(name, ()):
+                if any(sym in self.dirty for sym in fs.returns):
+                    return True
+        return False
+
+
+class RewriteTrusted(ast.NodeTransformer):
+    '''
+    Rewrite f(args) as getattr(f, 'trusted', f)(args) for the given call
+    nodes, so the calls keep working with taint tracking off (see
+    taintmode.taint_tracking), when f is left undecorated.
+    '''
+
+    def __init__(self, calls):
+        self.calls = calls
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if id(node) in self.calls:
+            f = node.func
+            trusted = ast.Call(func=ast.Name(id='getattr', ctx=ast.Load()),
+                               args=[f, ast.Str(s='trusted'), copy(f)],
+                               keywords=[], starargs=None, kwargs=None)
+            node.func = ast.fix_missing_locations(ast.copy_location(trusted,
+                                                                    f))
+        return node
+
+
+def copy(node):
+    '''Copy the name or dotted name node.'''
+    if isinstance(node, ast.Attribute):
+        return ast.copy_location(ast.Attribute(value=copy(node.value),
+                                               attr=node.attr,
+                                               ctx=ast.Load()), node)
+    return ast.copy_location(ast.Name(id=node.id, ctx=ast.Load()), node)
+
+
+def rewrite(trees):
+    '''
+    Rewrite the trusted calls of the parsed modules of a program, in place,
+    and return the Analysis used.
+    '''
+    analysis = Analysis(trees)
+    for t in trees:
+        RewriteTrusted(analysis.trusted_calls(t)).visit(t)
+    return analysis
+
+
+if __name__ == '__main__':
+    import sys
+    trees = [ast.parse(open(f).read(), f) for f in sys.argv[1:]]
+    analysis = rewrite(trees)
+    for name in analysis.clean_functions():
+        print '# clean: %s' % name
+    print codegen.to_source(trees[0])
@@ -109,7 +109,7 @@ class SourceGenerator(NodeVisitor):
         self.newline(node)
         for idx, target in enumerate(node.targets):
             if idx:
-                self.write(', ')
+                self.write(' = ')
             self.visit(target)
         self.write(' = ')
         self.visit(node.value)
@@ -263,6 +263,10 @@ class SourceGenerator(NodeVisitor):
         self.body(node.body)
         for handler in node.handlers:
             self.visit(handler)
+        if node.orelse:
+            self.newline()
+            self.write('else:')
+            self.body(node.orelse)
 
     def visit_TryFinally(self, node):
         self.newline(node)
@@ -304,6 +308,7 @@ class SourceGenerator(NodeVisitor):
                 self.write(' from ')
                 self.visit(node.cause)
         elif hasattr(node, 'type') and node.type is not None:
+            self.write(' ')
             self.visit(node.type)
             if node.inst is not None:
                 self.write(', ')
@@ -528,3 +533,5 @@ class SourceGenerator(NodeVisitor):
                 self.visit(node.name)
         self.write(':')
         self.body(node.body)
+
+    visit_ExceptHandler = visit_excepthandler
@@ -0,0 +1,675 @@
+'''
+Shadow variables taint engine
+
+An alternative to the taint-aware classes of taintmode.py, selected per
+module. The source of the selected modules is rewritten on import so each
+variable x gets a shadow variable x__t holding the bitmask of the tags of
+its value, and values stay plain str, int, ... using CPython's own
+operations. Only calls go through this module: call carries the labels of
+the arguments to instrumented functions, and makes the values taint-aware
+(in taintmode.py's sense) before they reach other code, so untrusted,
+ssink, cleaner and validator are used as always.
+
+Use:
+
+    import shadow
+    shadow.install('myapp.views', 'myapp.models')
+
+or put __taint_engine__ = 'shadow' in the modules and call shadow.install()
+with no arguments. To see how a file is rewritten:
+
+    python shadow.py file.py
+
+Values stored in containers or attributes, yielded, or used inside lambdas,
+comprehensions and class bodies are made taint-aware, so their tags are
+kept by the values themselves. Validators can't remove tags from shadow
+variables, so inside instrumented code use cleaners instead.
+'''
+import imp
+import os
+import sys
+import threading
+
+# taintmode.py is in the parent directory, when not installed
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if root not in sys.path:
+    sys.path.append(root)
+
+from gen import ast, codegen
+import taintmode
+
+MARKER = "__taint_engine__ = 'shadow'"
+
+# ------------------------- Runtime -------------------------------------------
+
+state = threading.local()
+instrumented = set()    # code objects of the instrumented functions
+
+pure_builtins = set([len, str, unicode, int, long, float, bool, repr, abs,
+                     min, max, sum, sorted, reversed, range, xrange,
+                     enumerate, zip, ord, chr, unichr, hex, oct, round,
+                     isinstance, issubclass, hasattr, getattr, type, tuple,
+                     list, dict, set, frozenset, iter, next, hash, id, cmp,
+                     divmod, pow, format, any, all])
+propagated = set([taintmode.len, taintmode.ord, taintmode.chr])
+immutable = (basestring, int, long, float, tuple, frozenset, type(None))
+builtin_callables = (type(len), type(''.join), type(str.join),
+                     type(''.__add__))
+plain_types = (str, unicode, int, long, float)
+CO_GENERATOR = 0x20
+
+
+def label(v):
+    '''Return the bitmask of the tags v carries itself.'''
+    return getattr(v, '_taint_label', taintmode.EMPTY).mask
+
+
+def box(v, l):
+    '''Return v taint-aware, tainted with the bitmask l.'''
+    if not l:
+        return v
+    return taintmode.taint_aware(v, taintmode.label(l))
+
+
+def unbox(v):
+    '''Return a plain version of v if it's a taint-aware str, int, ...'''
+    if type(v) in plain_types or not hasattr(v, '_taint_label'):
+        return v
+    for t in plain_types:
+        if isinstance(v, t):
+            return t(v)
+    return v
+
+
+def drain(acc):
+    '''Return the labels of the calls made since last drain, or'ed.'''
+    l = 0
+    for x in acc:
+        l |= x
+    del acc[:]
+    return l
+
+
+def clear(acc, v):
+    del acc[:]
+    return v
+
+
+def pop(acc):
+    '''Return the label of the call just made, the last appended to acc.'''
+    return acc.pop()
+
+
+def read(acc, v):
+    '''Record the label of v, read from a container or an attribute.'''
+    l = label(v)
+    if l:
+        acc.append(l)
+    return v
+
+
+def code_of(f):
+    f = getattr(f, 'im_func', f)
+    return getattr(f, 'func_code', None)
+
+
+def member(f, s):
+    try:
+        return f in s
+    except TypeError:
+        # methods bound to unhashable objects
+        return False
+
+
+def pure(f):
+    '''Tell if f is a builtin that can't keep its arguments anywhere.'''
+    if member(f, pure_builtins):
+        return True
+    return isinstance(f, builtin_callables) and \
+           isinstance(getattr(f, '__self__', None), immutable)
+
+
+def call(acc, f, lf, labels, *args, **kwargs):
+    '''
+    Call f with args and kwargs, labelled with the bitmasks in labels (one
+    per positional argument in the call expression) and lf (the function
+    expression, keyword and star arguments). The label of the result is
+    appended to acc, or if acc is None, kept by the result itself.
+    '''
+    code = code_of(f)
+    if code in instrumented and not code.co_flags & CO_GENERATOR:
+        if getattr(f, 'im_self', None) is not None:
+            labels = (lf,) + labels
+        state.pending = (code, labels, lf)
+        state.ret_code = None
+        r = f(*args, **kwargs)
+        if state.ret_code is code:
+            l = state.ret_label
+        else:
+            l = 0
+    else:
+        l = lf
+        for x in labels:
+            l |= x
+        if member(f, propagated):
+            r = getattr(f, 'trusted', f)(*args, **kwargs)
+            for a in args:
+                l |= label(a)
+        elif pure(f):
+            r = f(*args, **kwargs)
+            for a in args:
+                if isinstance(a, taintmode.containers):
+                    l |= taintmode.collect_tags(a).mask
+                else:
+                    l |= label(a)
+        else:
+            n = labels.__len__()
+            args = [box(a, (labels[i] if i < n else 0) | lf)
+                    for i, a in enumerate(args)]
+            for k in kwargs:
+                kwargs[k] = box(kwargs[k], lf)
+            r = f(*args, **kwargs)
+            if hasattr(f, 'trusted'):
+                # sinks, cleaners and validators, they know better
+                l = 0
+    l |= label(r)
+    r = unbox(r)
+    if acc is None:
+        return box(r, l) if type(r) in plain_types else r
+    acc.append(l)
+    return r
+
+
+def enter(*values):
+    '''
+    Return the labels of the parameters of the instrumented function
+    calling, given their values.
+    '''
+    pending = getattr(state, 'pending', None)
+    state.pending = None
+    if pending is not None and pending[0] is sys._getframe(1).f_code:
+        code, labels, extra = pending
+        n = labels.__len__()
+        return tuple((labels[i] if i < n else extra) | label(v)
+                     for i, v in enumerate(values))
+    # called from code not instrumented, values carry their own tags
+    return tuple(label(v) for v in values)
+
+
+def ret(v, l):
+    '''Record l as the label of v, returned by the calling function.'''
+    state.ret_code = sys._getframe(1).f_code
+    state.ret_label = l
+    if type(v) in plain_types:
+        # for callers not instrumented, call unboxes it again
+        return box(v, l)
+    return v
+
+# ------------------------- Rewriting -----------------------------------------
+
+ACC = '_shadow_acc'
+RUNTIME = '_shadow'
+
+
+def shadow_name(name):
+    return name + '__t'
+
+
+def load(name):
+    return ast.Name(id=name, ctx=ast.Load())
+
+
+def store(name):
+    return ast.Name(id=name, ctx=ast.Store())
+
+
+def runtime(fname, *args):
+    return ast.Call(func=ast.Attribute(value=load(RUNTIME), attr=fname,
+                                       ctx=ast.Load()),
+                    args=list(args), keywords=[], starargs=None, kwargs=None)
+
+
+def or_all(exprs):
+    exprs = list(exprs)
+    if not exprs:
+        return ast.Num(n=0)
+    r = exprs[0]
+    for e in exprs[1:]:
+        r = ast.BinOp(left=r, op=ast.BitOr(), right=e)
+    return r
+
+
+def stored_names(target):
+    '''Names bound by the assignment target.'''
+    return [n.id for n in ast.walk(target) if isinstance(n, ast.Name) and
+            isinstance(n.ctx, (ast.Store, ast.Param))]
+
+
+def is_names(target):
+    return all(isinstance(n, (ast.Name, ast.Tuple, ast.List, ast.Store,
+                              ast.Load))
+               for n in ast.walk(target))
+
+
+def scope_names(body, params=()):
+    '''Return the names bound in a scope and those declared global.'''
+    bound = set(params)
+    declared = set()
+    stack = list(body)
+    while stack:
+        n = stack.pop()
+        if isinstance(n, (ast.FunctionDef, ast.ClassDef)):
+            bound.add(n.name)
+            stack.extend(n.decorator_list)
+            if isinstance(n, ast.FunctionDef):
+                stack.extend(n.args.defaults)
+            else:
+                stack.extend(n.bases)
+            continue
+        if isinstance(n, (ast.Lambda, ast.GeneratorExp, ast.SetComp,
+                          ast.DictComp)):
+            continue
+        if isinstance(n, ast.Global):
+            declared.update(n.names)
+        elif isinstance(n, ast.Name) and isinstance(n.ctx, ast.Store):
+            bound.add(n.id)
+        elif isinstance(n, (ast.Import, ast.ImportFrom)):
+            bound.update((a.asname or a.name).split('.')[0]
+                         for a in n.names if a.name != '*')
+        stack.extend(ast.iter_child_nodes(n))
+    bound = set(b for b in bound if not b.startswith('_shadow'))
+    return bound - declared, declared
+
+
+class Instrument(object):
+    '''Rewrite a parsed module to keep the labels in shadow variables.'''
+
+    def __init__(self):
+        self.scopes = []    # names with a shadow, innermost last
+        self.count = 0
+        self.nested = 0
+
+    def tracked(self, name):
+        return any(name in s for s in self.scopes)
+
+    def temp(self, prefix):
+        self.count += 1
+        return '_shadow_%s%d' % (prefix, self.count)
+
+    # expressions
+
+    def static(self, node):
+        '''Expression or'ing the shadows of the variables node reads.'''
+        names = []
+        stack = [node]
+        while stack:
+            n = stack.pop(0)
+            if isinstance(n, ast.Call):
+                continue    # call records the label of its result
+            if isinstance(n, ast.Name) and isinstance(n.ctx, ast.Load) and \
+               self.tracked(n.id) and n.id not in names:
+                names.append(n.id)
+            stack.extend(ast.iter_child_nodes(n))
+        return or_all(load(shadow_name(n)) for n in names)
+
+    def value_label(self, node):
+        return ast.BinOp(left=self.static(node), op=ast.BitOr(),
+                         right=runtime('drain', load(ACC)))
+
+    def expr(self, node, acc=True):
+        if isinstance(node, ast.Call):
+            return self.call(node, acc and not self.nested)
+        if isinstance(node, (ast.Subscript, ast.Attribute)):
+            if isinstance(node.ctx, ast.Load):
+                return runtime('read', load(ACC), self.generic(node))
+            return self.generic(node)
+        if isinstance(node, (ast.Lambda, ast.ListComp, ast.GeneratorExp,
+                             ast.SetComp, ast.DictComp)):
+            return self.boxed(node)
+        if isinstance(node, ast.Yield) and node.value is not None:
+            l = self.value_label(node.value)
+            return ast.Yield(value=runtime('box', self.expr(node.value), l))
+        return self.generic(node)
+
+    def generic(self, node):
+        for field, old in ast.iter_fields(node):
+            if isinstance(old, list):
+                setattr(node, field, [self.expr(x) if isinstance(x, ast.expr)
+                                      else x for x in old])
+            elif isinstance(old, ast.expr):
+                setattr(node, field, self.expr(old))
+            elif isinstance(old, ast.slice):
+                setattr(node, field, self.generic(old))
+            elif isinstance(old, ast.keyword):
+                old.value = self.expr(old.value)
+        if isinstance(node, ast.Call):
+            for k in node.keywords:
+                k.value = self.expr(k.value)
+        return node
+
+    def call(self, node, acc=True):
+        extra = [node.func] + [k.value for k in node.keywords]
+        extra.extend(a for a in (node.starargs, node.kwargs) if a is not None)
+        lf = or_all(self.static(e) for e in extra)
+        labels = ast.Tuple(elts=[self.static(a) for a in node.args],
+                           ctx=ast.Load())
+        # calls inside this one give values carrying their own tags
+        self.nested += 1
+        try:
+            func = node.func
+            if isinstance(func, ast.Call):
+                # the function is the result of a call, which can't carry
+                # its label: it goes through acc, evaluated just before lf
+                func = self.call(func)
+                lf = ast.BinOp(left=lf, op=ast.BitOr(),
+                               right=runtime('pop', load(ACC)))
+            elif isinstance(func, ast.Attribute):
+                # a method lookup, not a read
+                func.value = self.expr(func.value)
+            else:
+                func = self.expr(func)
+            args = [self.expr(a) for a in node.args]
+            for k in node.keywords:
+                k.value = self.expr(k.value)
+            starargs = node.starargs and self.expr(node.starargs)
+            kwargs = node.kwargs and self.expr(node.kwargs)
+        finally:
+            self.nested -= 1
+        return ast.Call(func=ast.Attribute(value=load(RUNTIME), attr='call',
+                                           ctx=ast.Load()),
+                        args=[load(ACC) if acc else load('None'), func, lf,
+                              labels] + args,
+                        keywords=node.keywords, starargs=starargs,
+                        kwargs=kwargs)
+
+    def boxed(self, node):
+        '''Leave node to taintmode: its variables are made taint-aware.'''
+        bound = set()
+        for n in ast.walk(node):
+            if isinstance(n, ast.Name) and isinstance(n.ctx, (ast.Store,
+                                                              ast.Param)):
+                bound.add(n.id)
+        instrument = self
+
+        class Box(ast.NodeTransformer):
+            def visit_Name(self, n):
+                if isinstance(n.ctx, ast.Load) and n.id not in bound and \
+                   instrument.tracked(n.id):
+                    return runtime('box', n, load(shadow_name(n.id)))
+                return n
+        return Box().visit(node)
+
+    # statements
+
+    def body(self, stmts):
+        r = []
+        for s in stmts:
+            for n in self.stmt(s):
+                # keep the line numbers growing, as the compiler expects
+                if not hasattr(n, 'lineno'):
+                    ast.copy_location(n, s)
+                r.append(ast.fix_missing_locations(n))
+        return r or [ast.Pass()]
+
+    def set_shadows(self, target, value):
+        names = [shadow_name(n) for n in stored_names(target)
+                 if self.tracked(n)]
+        if not names:
+            return []
+        return [ast.Assign(targets=[store(n) for n in names], value=value)]
+
+    def stmt(self, node):
+        if isinstance(node, ast.FunctionDef):
+            return [self.function(node)]
+        if isinstance(node, ast.ClassDef):
+            node.bases = [self.expr(b) for b in node.bases]
+            node.decorator_list = [self.expr(d) for d in node.decorator_list]
+            node.body = [self.function(s) if isinstance(s, ast.FunctionDef)
+                         else self.boxed(s) for s in node.body]
+            return [node]
+        if isinstance(node, ast.Assign):
+            return self.assign(node)
+        if isinstance(node, ast.AugAssign):
+            l = self.value_label(node.value)
+            if isinstance(node.target, ast.Name):
+                r = [ast.AugAssign(target=node.target, op=node.op,
+                                   value=self.expr(node.value))]
+                if self.tracked(node.target.id):
+                    s = shadow_name(node.target.id)
+                    r.append(ast.Assign(targets=[store(s)], value=ast.BinOp(
+                        left=load(s), op=ast.BitOr(), right=l)))
+                return r
+            node.value = runtime('box', self.expr(node.value), l)
+            node.target = self.expr(node.target)
+            return [node]
+        if isinstance(node, ast.Return) and node.value is not None:
+            l = self.value_label(node.value)
+            node.value = runtime('ret', self.expr(node.value), l)
+            return [node]
+        if isinstance(node, ast.Expr):
+            if isinstance(node.value, ast.Call):
+                node.value = self.call(node.value, acc=False)
+            else:
+                node.value = self.expr(node.value)
+            return [node]
+        if isinstance(node, (ast.If, ast.While)):
+            node.test = runtime('clear', load(ACC), self.expr(node.test))
+            node.body = self.body(node.body)
+            node.orelse = node.orelse and self.body(node.orelse)
+            return [node]
+        if isinstance(node, ast.For):
+            it, il = self.temp('iter'), self.temp('label')
+            l = self.value_label(node.iter)
+            r = [ast.Assign(targets=[store(it)], value=self.expr(node.iter)),
+                 ast.Assign(targets=[store(il)], value=l)]
+            node.iter = load(it)
+            node.target = self.expr(node.target)
+            node.body = self.set_shadows(node.target, load(il)) + \
+                        self.body(node.body)
+            node.orelse = node.orelse and self.body(node.orelse)
+            return r + [node]
+        if isinstance(node, ast.With):
+            shadows = []
+            if node.optional_vars is not None:
+                shadows = self.set_shadows(node.optional_vars,
+                                           self.value_label(node.context_expr))
+            node.context_expr = self.expr(node.context_expr)
+            if node.optional_vars is not None:
+                node.optional_vars = self.expr(node.optional_vars)
+            node.body = shadows + self.body(node.body)
+            return [node]
+        if isinstance(node, ast.TryExcept):
+            node.body = self.body(node.body)
+            for h in node.handlers:
+                shadows = []
+                if isinstance(h.name, ast.Name):
+                    l = runtime('label', load(h.name.id))
+                    shadows = self.set_shadows(h.name, l)
+                h.body = shadows + self.body(h.body)
+            node.orelse = node.orelse and self.body(node.orelse)
+            return [node]
+        if isinstance(node, ast.TryFinally):
+            node.body = self.body(node.body)
+            node.finalbody = self.body(node.finalbody)
+            return [node]
+        if isinstance(node, ast.Global):
+            node.names = node.names + [shadow_name(n) for n in node.names]
+            return [node]
+        if isinstance(node, (ast.Import, ast.ImportFrom, ast.Pass,
+                             ast.Break, ast.Continue)):
+            return [node]
+        return [self.generic(node)]
+
+    def assign(self, node):
+        l = self.value_label(node.value)
+        value = self.expr(node.value)
+        if all(is_names(t) for t in node.targets):
+            names = []
+            for t in node.targets:
+                names.extend(n for n in stored_names(t) if self.tracked(n))
+            r = [ast.Assign(targets=node.targets, value=value)]
+            if names:
+                r.append(ast.Assign(targets=[store(shadow_name(n))
+                                             for n in names], value=l))
+            return r
+        v, lv = self.temp('value'), self.temp('label')
+        r = [ast.Assign(targets=[store(v)], value=value),
+             ast.Assign(targets=[store(lv)], value=l)]
+        for t in node.targets:
+            if isinstance(t, ast.Name):
+                r.append(ast.Assign(targets=[t], value=load(v)))
+            else:
+                r.append(ast.Assign(targets=[self.expr(t)],
+                                    value=runtime('box', load(v), load(lv))))
+            r.extend(self.set_shadows(t, load(lv)))
+        return r
+
+    def function(self, node):
+        node.decorator_list = [self.expr(d) for d in node.decorator_list]
+        node.args.defaults = [self.expr(d) for d in node.args.defaults]
+        params = []
+        for a in node.args.args:
+            params.extend(stored_names(a))
+        params.extend(p for p in (node.args.vararg, node.args.kwarg) if p)
+        bound, declared = scope_names(node.body, params)
+        self.scopes.append(bound)
+        try:
+            body = node.body
+            doc = []
+            if body and isinstance(body[0], ast.Expr) and \
+               isinstance(body[0].value, ast.Str):
+                doc, body = body[:1], body[1:]
+            init = [ast.Assign(targets=[store(ACC)],
+                               value=ast.List(elts=[], ctx=ast.Load()))]
+            if params:
+                init.append(ast.Assign(
+                    targets=[ast.Tuple(elts=[store(shadow_name(p))
+                                             for p in params],
+                                       ctx=ast.Store())],
+                    value=runtime('enter', *[load(p) for p in params])))
+            others = sorted(bound - set(params))
+            if others:
+                init.append(ast.Assign(targets=[store(shadow_name(n))
+                                                for n in others],
+                                       value=ast.Num(n=0)))
+            for n in init:
+                ast.fix_missing_locations(ast.copy_location(n, node))
+            node.body = doc + init + self.body(body)
+        finally:
+            self.scopes.pop()
+        return node
+
+    def module(self, tree):
+        bound, declared = scope_names(tree.body)
+        self.scopes.append(bound)
+        body = tree.body
+        head = []
+        while body and (isinstance(body[0], ast.ImportFrom) and
+                        body[0].module == '__future__' or
+                        isinstance(body[0], ast.Expr) and
+                        isinstance(body[0].value, ast.Str)):
+            head.append(body[0])
+            body = body[1:]
+        init = [ast.Assign(targets=[store(ACC)],
+                           value=ast.List(elts=[], ctx=ast.Load()))]
+        if bound:
+            init.append(ast.Assign(targets=[store(shadow_name(n))
+                                            for n in sorted(bound)],
+                                   value=ast.Num(n=0)))
+        for n in init:
+            ast.fix_missing_locations(ast.copy_location(n, (body or
+                                                            head)[0]))
+        tree.body = head + init + self.body(body)
+        self.scopes.pop()
+        return ast.fix_missing_locations(tree)
+
+
+def instrument(tree):
+    '''Rewrite the parsed module tree, in place, and return it.'''
+    return Instrument().module(tree)
+
+
+def register(code):
+    '''Record code and the functions defined in it as instrumented.'''
+    instrumented.add(code)
+    for c in code.co_consts:
+        if isinstance(c, type(code)):
+            register(c)
+
+
+def load_source(name, source, filename='<shadow>'):
+    '''Create the module name, instrumenting its source.'''
+    code = compile(instrument(ast.parse(source, filename)), filename, 'exec')
+    register(code)
+    mod = imp.new_module(name)
+    mod.__file__ = filename
+    mod.__dict__[RUNTIME] = sys.modules[__name__]
+    sys.modules[name] = mod
+    try:
+        exec code in mod.__dict__
+    except:
+        del sys.modules[name]
+        raise
+    return mod
+
+# ------------------------- Import hook ---------------------------------------
+
+
+class ShadowImporter(object):
+    '''
+    Import hook instrumenting the modules named, or if names is None those
+    having the line __taint_engine__ = 'shadow'.
+    '''
+
+    def __init__(self, names=None):
+        self.names = names
+        self.paths = {}
+
+    def find_module(self, fullname, path=None):
+        if self.names is not None and fullname not in self.names:
+            return None
+        try:
+            f, pathname, desc = imp.find_module(fullname.rpartition('.')[2],
+                                                path)
+        except ImportError:
+            return None
+        if f is None:
+            return None     # packages are left alone
+        try:
+            if desc[2] != imp.PY_SOURCE:
+                return None
+            if self.names is None and MARKER not in f.read():
+                return None
+        finally:
+            f.close()
+        self.paths[fullname] = pathname
+        return self
+
+    def load_module(self, fullname):
+        if fullname in sys.modules:
+            return sys.modules[fullname]
+        pathname = self.paths.pop(fullname)
+        mod = load_source(fullname, open(pathname).read(), pathname)
+        mod.__loader__ = self
+        return mod
+
+
+def install(*names):
+    '''Instrument the modules named, or those marked, from now on.'''
+    importer = ShadowImporter(set(names) if names else None)
+    sys.meta_path.insert(0, importer)
+    return importer
+
+
+def uninstall(importer):
+    sys.meta_path.remove(importer)
+
+
+# violations are reported at the line of the instrumented code, not here
+taintmode.hidden_modules.add(__name__)
+
+
+if __name__ == '__main__':
+    a = instrument(ast.parse(open(sys.argv[1]).read()))
+    print 'import shadow as %s' % RUNTIME
+    print codegen.to_source(a)
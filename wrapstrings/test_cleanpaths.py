@@ -0,0 +1,138 @@
+import unittest
+
+from gen import ast
+from cleanpaths import Analysis, rewrite
+from gen.codegen import to_source
+
+
+PROGRAM = '''
+from taintmode import *
+
+@untrusted
+def get_input():
+    return 'user data'
+
+@ssink(SQLI)
+def save(q):
+    return q
+
+def build(x):
+    return "select " + x
+
+def count(items):
+    return len(items)
+
+def handle():
+    data = get_input()
+    save(build(data))
+    save('constant')
+    acc = []
+    other = acc
+    acc.append(data)
+    save(other)
+    count(['a'])
+'''
+
+
+def analyze(source):
+    tree = ast.parse(source)
+    return tree, rewrite([tree])
+
+
+class TestCleanPaths(unittest.TestCase):
+
+    def test_clean_functions(self):
+        tree, a = analyze(PROGRAM)
+        self.assertEqual(a.clean_functions(), ['count'])
+
+    def test_rewrite(self):
+        tree, a = analyze(PROGRAM)
+        source = to_source(tree)
+        self.assertTrue("getattr(save, 'trusted', save)('constant')"
+                        in source)
+        self.assertTrue("return getattr(len, 'trusted', len)(items)"
+                        in source)
+        self.assertTrue('save(build(data))' in source)
+
+    def test_alias_mutation(self):
+        tree, a = analyze(PROGRAM)
+        self.assertTrue('save(other)' in to_source(tree))
+
+    def test_call_mutation(self):
+        tree, a = analyze(PROGRAM + '\nd = {}\n'
+                          "d.setdefault('k', []).append(get_input())\n"
+                          "save(d['k'][0])\n")
+        self.assertTrue("save(d['k'][0])" in to_source(tree))
+
+    def test_dirty_cleaner(self):
+        tree, a = analyze(PROGRAM + '\n@cleaner(SQLI)\n'
+                                    'def sanitized():\n'
+                                    '    return get_input().replace("a", "")\n'
+                                    '@cleaner(SQLI)\n'
+                                    'def quoted():\n'
+                                    '    return "x"\n'
+                                    'save(sanitized())\n'
+                                    'save(quoted())\n')
+        source = to_source(tree)
+        self.assertTrue('save(sanitized())' in source)
+        self.assertTrue("getattr(quoted, 'trusted', quoted)()" in source)
+
+    def test_module_attribute(self):
+        config = ast.parse('from taintmode import *\n'
+                           '@untrusted\n'
+                           'def read():\n'
+                           '    return "x"\n'
+                           'value = read()\n')
+        main = ast.parse('import config\n'
+                         'from taintmode import *\n'
+                         '@ssink(SQLI)\n'
+                         'def query(q):\n'
+                         '    return q\n'
+                         'query(config.value)\n')
+        rewrite([main, config])
+        self.assertTrue('query(config.value)' in to_source(main))
+        self.assertFalse("'trusted'" in to_source(main))
+
+    def test_module_attribute_set(self):
+        main = ast.parse(PROGRAM + '\nimport other\n'
+                                   'other.value = get_input()\n')
+        other = ast.parse('from taintmode import *\n'
+                          '@ssink(SQLI)\n'
+                          'def save2(q):\n'
+                          '    return q\n'
+                          'value = None\n'
+                          'def use():\n'
+                          '    save2(value)\n')
+        rewrite([main, other])
+        self.assertTrue('save2(value)' in to_source(other))
+        self.assertFalse("'trusted'" in to_source(other))
+
+    def test_opaque(self):
+        tree, a = analyze(PROGRAM + '\neval("1")\n')
+        self.assertEqual(a.clean_functions(), [])
+        self.assertFalse("'trusted'" in to_source(tree))
+
+    def test_plain_rebinding(self):
+        tree, a = analyze(PROGRAM + '\nsave = 1\n')
+        self.assertFalse("getattr(save" in to_source(tree))
+
+    def test_wrapped_sink(self):
+        tree, a = analyze('from taintmode import *\n'
+                          'import db\n'
+                          'db.delete = ssink(SQLI)(db.delete)\n'
+                          'db.delete(3)\n'
+                          'db.delete(taint(3))\n')
+        source = to_source(tree)
+        self.assertTrue("getattr(db.delete, 'trusted', db.delete)(3)"
+                        in source)
+        self.assertTrue('db.delete(taint(3))' in source)
+
+    def test_module(self):
+        tree = ast.parse('x = 1\ny = x + 2\n')
+        self.assertTrue(Analysis([tree]).clean_module(tree))
+        tree = ast.parse('x = taint(1)\n')
+        self.assertFalse(Analysis([tree]).clean_module(tree))
+
+
+if __name__ == '__main__':
+    unittest.main()
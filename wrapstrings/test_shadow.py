@@ -0,0 +1,137 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import shadow     # puts taintmode.py, in the parent directory, on sys.path
+import taintmode
+from gen import ast
+from gen.codegen import to_source
+
+
+PROGRAM = '''
+from taintmode import *
+
+reports = []
+
+def reached(t, v=None):
+    reports.append(t)
+
+@untrusted
+def get_input():
+    return 'user data'
+
+@ssink(SQLI, reached=reached)
+def save(q):
+    return q
+
+@cleaner(SQLI)
+def escape(s):
+    return s.replace("'", "''")
+
+def build(x, prefix='select '):
+    q = prefix
+    q += x
+    return q
+
+def plain_types(x):
+    return type(x) is str
+
+class Query(object):
+    def __init__(self, text):
+        self.text = text
+
+    def render(self, where):
+        return self.text + ' where ' + where
+
+def loop(items):
+    r = ''
+    for i in items:
+        r = r + i
+    return r
+
+def handle():
+    data = get_input()
+    save(build(data))
+    save(build('constant'))
+    save(escape(data))
+    save(Query('select').render(data))
+    save(loop(['a', data]))
+    try:
+        raise ValueError(data)
+    except ValueError, e:
+        save(e.args[0])
+    return plain_types(data)
+'''
+
+def load(source=PROGRAM):
+    return shadow.load_source('shadow_program', source)
+
+
+class TestShadow(unittest.TestCase):
+
+    def tearDown(self):
+        sys.modules.pop('shadow_program', None)
+
+    def test_flows(self):
+        m = load()
+        self.assertTrue(m.handle())
+        self.assertEqual(m.reports, ['select user data',
+                                     'select where user data',
+                                     'auser data', 'user data'])
+
+    def test_plain_caller(self):
+        m = load()
+        # the tags travel with the value when the caller isn't instrumented
+        r = m.build(taintmode.taint('x', SQLI))
+        self.assertEqual(r, 'select x')
+        self.assertEqual(r.taints, set([SQLI]))
+        m.save(r)
+        self.assertEqual(m.reports, ['select x'])
+
+    def test_function_from_call(self):
+        m = load(PROGRAM + '''
+def lookup():
+    data = get_input()
+    save(getattr(data, 'upper')())
+    return getattr(data, 'strip')()
+''')
+        r = m.lookup()
+        self.assertEqual(m.reports, ['USER DATA'])
+        self.assertEqual(r.taints, set([1, 2, 3, 4]))
+
+    def test_compiles(self):
+        tree = shadow.instrument(ast.parse(PROGRAM))
+        source = to_source(tree)
+        self.assertTrue('q__t = ' in source)
+        compile(source, '<test>', 'exec')
+
+    def test_import_hook(self):
+        d = tempfile.mkdtemp()
+        try:
+            for name, marker in [('marked_mod', shadow.MARKER),
+                                 ('plain_mod', '')]:
+                f = open(os.path.join(d, name + '.py'), 'w')
+                f.write(marker + '\ndef f(x):\n    return x\n')
+                f.close()
+            sys.path.insert(0, d)
+            importer = shadow.install()
+            try:
+                import marked_mod, plain_mod
+            finally:
+                shadow.uninstall(importer)
+                sys.path.remove(d)
+            self.assertTrue(marked_mod.f.func_code in shadow.instrumented)
+            self.assertFalse(plain_mod.f.func_code in shadow.instrumented)
+        finally:
+            sys.modules.pop('marked_mod', None)
+            sys.modules.pop('plain_mod', None)
+            shutil.rmtree(d)
+
+
+SQLI = taintmode.SQLI
+
+
+if __name__ == '__main__':
+    unittest.main()